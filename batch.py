@@ -0,0 +1,388 @@
+from chromamature import make_run_dirs, report_run
+from scripts.image_analysis import process_runs_parallel, gray_decode
+from scripts.cache import open_cache, close_cache, clear_cache
+from scripts.results import open_writer, close_writer, save_store
+from scripts.metrics import new_metrics, stage, count, write_metrics
+from scripts.timeline import build_timeline
+from concurrent import futures
+import pandas as pd
+import argparse
+import os
+import sys
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# A manifest has one run per row (csv) or entry (yaml), with the same names as
+# the chromamature.py flags. impath, coords and time are required, roi_size,
+# decode, name and time_pattern are optional. Relative paths are relative to the
+# manifest:
+#
+#   impath,coords,time,roi_size,name
+#   plate_01/images,plate_01/coords.csv,5,5,plate_01
+#
+# or in yaml, as a list or under a runs key:
+#
+#   runs:
+#     - {impath: plate_01/images, coords: plate_01/coords.csv, time: 5}
+
+REQUIRED = ("impath", "coords", "time")
+
+
+def _value(run, key, default=None):
+    # Empty csv cells are read as NaN
+    value = run.get(key)
+    if value is None or (isinstance(value, float) and value != value):
+        return default
+    return value
+
+
+def read_manifest(path):
+    """
+    The runs of a csv or yaml manifest as a list of dicts with impath, coords,
+    time, roi_size, decode, name and time_pattern.
+    """
+    if path.endswith((".yaml", ".yml")):
+        try:
+            import yaml
+        except ImportError:
+            raise ImportError(
+                "Reading a yaml manifest needs PyYAML (pip install pyyaml), or use a csv manifest."
+            )
+        with open(path) as f:
+            entries = yaml.safe_load(f) or []
+        if isinstance(entries, dict):
+            entries = entries.get("runs", [])
+    else:
+        entries = pd.read_csv(path, skipinitialspace=True).to_dict("records")
+
+    base = os.path.dirname(os.path.abspath(path))
+    runs = []
+    names = set()
+    for i, entry in enumerate(entries):
+        missing = [key for key in REQUIRED if _value(entry, key) is None]
+        if missing:
+            raise ValueError(f"Run {i + 1} of {path} is missing {', '.join(missing)}.")
+
+        impath = os.path.join(base, str(entry["impath"]))
+        name = str(_value(entry, "name", os.path.basename(os.path.normpath(impath))))
+        if name in names:
+            raise ValueError(f"Run name {name} is used twice in {path}.")
+        names.add(name)
+
+        runs.append(
+            {
+                "impath": impath,
+                "coords": os.path.join(base, str(entry["coords"])),
+                "time": int(entry["time"]),
+                "roi_size": int(_value(entry, "roi_size", 5)),
+                "decode": _value(entry, "decode"),
+                "name": name,
+                "time_pattern": _value(entry, "time_pattern"),
+            }
+        )
+    return runs
+
+
+def _timeline(run, cache_dir):
+    # A run without a readable image directory fails later on its own
+    try:
+        return build_timeline(
+            run["impath"], run["time"], pattern=run["time_pattern"], cache_dir=cache_dir
+        )[0]
+    except Exception as e:
+        logger.error(f"Error in the timeline of {run['name']}: {e}")
+        return None
+
+
+def run_batch(
+    runs,
+    output_path,
+    workers=None,
+    decode="full",
+    use_cache=True,
+    cache_dir=None,
+    cache_size=1024,
+    export_results_csv=True,
+    segmentation="ruptures",
+    seed=0,
+    ci_method="percentile",
+    dpi=300,
+    plot_format="png",
+    color_decode=False,
+    reset_cache=False,
+):
+    """
+    Analyse every run of a manifest in one process pool. The frames of all runs
+    are scheduled together, then the halftimes and plots of each run are computed
+    on the same pool. Every run gets its usual directory in output_path, and the
+    intervals of all runs are combined in output_path/batch_summary.csv.
+    """
+    logger.info(f"Starting batch of {len(runs)} runs with workers={workers}.")
+    if cache_dir is None:
+        cache_dir = f"{output_path}/.chromamature_cache"
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+
+    workers = workers or os.cpu_count() or 1
+    cache = open_cache(cache_dir) if use_cache else None
+    if cache is not None and reset_cache:
+        logger.info(f"Clearing the frame cache in {cache_dir}.")
+        clear_cache(cache)
+    metrics = new_metrics()
+    metrics["runs"] = {}
+    batch_start = time.perf_counter()
+    summary = []
+    writers = []
+
+    try:
+        with futures.ProcessPoolExecutor(max_workers=workers) as ex:
+            with stage(metrics, "timeline"):
+                timelines = [
+                    _timeline(run, cache_dir if use_cache else None) for run in runs
+                ]
+
+            # The rows of every run are written to its directory as they come in
+            for run in runs:
+                run_path = f"{output_path}/{run['name']}"
+                make_run_dirs(run_path)
+                writers.append(open_writer(run_path, None, export_results_csv))
+
+            with stage(metrics, "analysis"):
+                all_results = process_runs_parallel(
+                    [
+                        {
+                            "folder_path": run["impath"],
+                            "coordinates": run["coords"],
+                            "time_interval": run["time"],
+                            "roi_size": run["roi_size"],
+                            # Batch runs measure gray values only
+                            "decode": (
+                                run["decode"] or decode
+                                if color_decode
+                                else gray_decode(run["decode"] or decode)
+                            ),
+                            "timeline": timeline,
+                            "writer": writer,
+                        }
+                        for run, timeline, writer in zip(runs, timelines, writers)
+                    ],
+                    workers=workers,
+                    cache=cache,
+                    metrics=metrics,
+                    executor=ex,
+                )
+                if all_results is None:
+                    raise RuntimeError("Image analysis of the batch failed.")
+
+                if cache is not None:
+                    close_cache(cache, cache_size)
+                    cache = None
+
+            for run, image_results, writer in zip(runs, all_results, writers):
+                run_path = f"{output_path}/{run['name']}"
+                run_metrics = new_metrics()
+                run_start = time.perf_counter()
+
+                try:
+                    with stage(run_metrics, "write_results"):
+                        analysed = image_results is not None
+                        image_results = close_writer(writer)
+                        if not analysed:
+                            raise RuntimeError(f"Could not analyse {run['impath']}.")
+                        save_store(image_results, run_path)
+                    count(run_metrics, "frames", len(image_results["time"]))
+
+                    data, label, conf_interval = report_run(
+                        image_results,
+                        run_path,
+                        workers=workers,
+                        segmentation=segmentation,
+                        seed=seed,
+                        ci_method=ci_method,
+                        dpi=dpi,
+                        plot_format=plot_format,
+                        metrics=run_metrics,
+                        executor=ex,
+                    )
+                    for halftimes, lab, ((lower, upper), mean) in zip(
+                        data, label, conf_interval
+                    ):
+                        summary.append(
+                            (run["name"], lab, len(halftimes), mean, lower, upper)
+                        )
+                    run_metrics["status"] = "finished"
+
+                except Exception as e:
+                    logger.error(f"Error in run {run['name']}: {e}", exc_info=True)
+                    run_metrics["status"] = "failed"
+                    run_metrics["error"] = repr(e)
+                finally:
+                    run_metrics["total_wall"] = time.perf_counter() - run_start
+                    write_metrics(run_metrics, f"{run_path}/run_metrics.json")
+                    metrics["runs"][run["name"]] = run_metrics["status"]
+
+        failed = [name for name, s in metrics["runs"].items() if s == "failed"]
+        metrics["status"] = "failed" if failed else "finished"
+
+    except Exception as e:
+        logger.error(f"Error: {e}", exc_info=True)
+        metrics["status"] = "failed"
+        metrics["error"] = repr(e)
+    finally:
+        if cache is not None:
+            close_cache(cache, cache_size)
+        for writer in writers:
+            if writer["file"] is not None:
+                close_writer(writer)
+
+        pd.DataFrame(
+            summary, columns=["run", "name", "n", "mean", "lower", "upper"]
+        ).to_csv(f"{output_path}/batch_summary.csv", index=False)
+        metrics["total_wall"] = time.perf_counter() - batch_start
+        write_metrics(metrics, f"{output_path}/batch_metrics.json")
+
+    return metrics
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Runs chromamature on every run of a manifest in one process"
+    )
+
+    parser.add_argument(
+        "-m",
+        "--manifest",
+        help="csv or yaml manifest with the impath, coords, time and optionally roi_size, decode and name of every run",
+        required=True,
+        type=str,
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="Output path, every run gets a directory named after it",
+        required=True,
+        type=str,
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="Number of workers of the shared pool, defaults to the number of cores",
+        default=None,
+        type=int,
+    )
+    parser.add_argument(
+        "-d",
+        "--decode",
+        help="Decode mode of runs that don't set one in the manifest",
+        default="full",
+        choices=[
+            "full",
+            "reduced2",
+            "reduced4",
+            "reduced8",
+            "full_gray",
+            "reduced2_gray",
+            "reduced4_gray",
+            "reduced8_gray",
+        ],
+    )
+    parser.add_argument(
+        "--color_decode",
+        help="Decode the pictures in color instead of grayscale, gives exactly the gray values of cvtColor",
+        default=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--no_cache",
+        help="Analyse every picture again instead of reusing cached results of unchanged pictures",
+        default=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        help="Directory of the frame cache, defaults to .chromamature_cache in the output directory",
+        default=None,
+        type=str,
+    )
+    parser.add_argument(
+        "--cache_size",
+        help="Maximum size of the frame cache in MB",
+        default=1024,
+        type=int,
+    )
+    parser.add_argument(
+        "--clear_cache",
+        help="Empty the frame cache before the analysis, so every picture is analysed again",
+        default=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--no_csv",
+        help="Only write the results to results.npz and skip the results.csv export",
+        default=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "-s",
+        "--segmentation",
+        help="How the plateau of each curve is found, ruptures (default) or fast. Both give the same halftimes, fast is about 10 times faster",
+        default="ruptures",
+        choices=["ruptures", "fast"],
+    )
+    parser.add_argument(
+        "--seed",
+        help="Seed of the bootstrap resampling",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--ci",
+        help="Bootstrap confidence interval, percentile (default) or bca",
+        default="percentile",
+        choices=["percentile", "bca"],
+    )
+    parser.add_argument(
+        "--dpi",
+        help="Resolution of the saved plots",
+        default=300,
+        type=int,
+    )
+    parser.add_argument(
+        "--plot_format",
+        help="File format of the plots, or none to skip plotting",
+        default="png",
+        choices=["png", "svg", "none"],
+    )
+
+    args = parser.parse_args()
+
+    logging.getLogger("matplotlib").setLevel(logging.WARNING)
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        handlers=[logging.FileHandler("chromamature.log")],
+    )
+
+    metrics = run_batch(
+        read_manifest(args.manifest),
+        args.output,
+        workers=args.workers,
+        decode=args.decode,
+        use_cache=not args.no_cache,
+        cache_dir=args.cache_dir,
+        cache_size=args.cache_size,
+        export_results_csv=not args.no_csv,
+        segmentation=args.segmentation,
+        seed=args.seed,
+        ci_method=args.ci,
+        dpi=args.dpi,
+        plot_format=args.plot_format,
+        color_decode=args.color_decode,
+        reset_cache=args.clear_cache,
+    )
+
+    if metrics["status"] == "failed":
+        sys.exit(1)
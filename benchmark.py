@@ -0,0 +1,453 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import platform
+import subprocess
+import tempfile
+import cv2
+import numpy as np
+import pandas as pd
+from scripts.image_analysis import process_images, process_images_parallel
+from scripts.registration import load_registration
+from scripts.results import results_to_store, sample_curves
+from scripts.plots import store_halftimes, render_plots, halftime
+from scripts.stat_test import bootstrap_means
+
+CLI = os.path.join(os.path.dirname(os.path.abspath(__file__)), "chromamature.py")
+# chromamature.py -h imports none of the heavy modules and must stay under this
+STARTUP_BUDGET = 0.5
+
+
+def make_timelapse(
+    path,
+    n_frames=100,
+    width=1920,
+    height=1080,
+    n_samples=6,
+    n_points=20,
+    noise=2.0,
+    seed=0,
+    drift=0,
+):
+    """
+    Write a synthetic timelapse of n_samples colonies that darken along a sigmoid
+    with random halftimes, plus a matching coords csv and circles.csv with one
+    circle ROI per colony. Every frame after the first is moved by up to drift
+    pixels in both directions, like a plate that shifts. Returns (image dir,
+    coords csv).
+    """
+    rng = np.random.default_rng(seed)
+    image_dir = os.path.join(path, "images")
+    os.makedirs(image_dir, exist_ok=True)
+
+    # Colonies on a grid, each with its own color, start and amount of change
+    cols = int(np.ceil(np.sqrt(n_samples * width / height)))
+    rows = int(np.ceil(n_samples / cols))
+    radius = int(min(width / cols, height / rows) * 0.35)
+    colonies = []
+    for i in range(n_samples):
+        cx = int((i % cols + 0.5) * width / cols)
+        cy = int((i // cols + 0.5) * height / rows)
+        colonies.append(
+            {
+                "center": (cx, cy),
+                "color": rng.uniform(0.3, 1.0, 3),
+                "halftime": rng.uniform(0.15, 0.5) * n_frames,
+                "steepness": rng.uniform(0.02, 0.08) * n_frames,
+                "change": rng.uniform(40, 120),
+            }
+        )
+
+    coords = []
+    for i, colony in enumerate(colonies):
+        cx, cy = colony["center"]
+        angle = rng.uniform(0, 2 * np.pi, n_points)
+        dist = radius * 0.8 * np.sqrt(rng.uniform(0, 1, n_points))
+        # The pipeline reads the csv y column as the image column and x as the row
+        for a, d in zip(angle, dist):
+            coords.append(
+                (
+                    f"sample_{i}",
+                    "C" + str(i % 10),
+                    int(cy + d * np.sin(a)),
+                    int(cx + d * np.cos(a)),
+                )
+            )
+    coords_path = os.path.join(path, "coords.csv")
+    pd.DataFrame(coords, columns=["name", "color", "x", "y"]).to_csv(
+        coords_path, index=False
+    )
+    pd.DataFrame(
+        {
+            "name": [f"sample_{i}" for i in range(n_samples)],
+            "color": ["C" + str(i % 10) for i in range(n_samples)],
+            "x": [colony["center"][1] for colony in colonies],
+            "y": [colony["center"][0] for colony in colonies],
+            "shape": "circle",
+            "radius": radius * 0.8,
+        }
+    ).to_csv(os.path.join(path, "circles.csv"), index=False)
+
+    background = np.full((height, width, 3), 210, dtype=np.uint8)
+    for t in range(n_frames):
+        frame = background.copy()
+        for colony in colonies:
+            level = 220 - colony["change"] / (
+                1 + np.exp(-(t - colony["halftime"]) / colony["steepness"])
+            )
+            color = tuple(int(c) for c in np.clip(level * colony["color"], 0, 255))
+            cv2.circle(frame, colony["center"], radius, color, -1)
+
+        if drift and t:
+            dx, dy = rng.integers(-drift, drift + 1, 2)
+            frame = np.roll(frame, (dy, dx), axis=(0, 1))
+        frame = frame + rng.normal(0, noise, frame.shape)
+        cv2.imwrite(
+            os.path.join(image_dir, f"IMG_{t:05d}.jpg"),
+            np.clip(frame, 0, 255).astype(np.uint8),
+        )
+
+    return image_dir, coords_path
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kB on Linux and bytes on macOS. It is the high-water mark of
+    # the whole process and its children, so it is only reported for the run
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / scale
+
+
+def _timed(stages, name, func, *args, **kwargs):
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = func(*args, **kwargs)
+    stages[name] = {
+        "wall": time.perf_counter() - wall,
+        "cpu": time.process_time() - cpu,
+    }
+    print(f"{name:<34} {stages[name]['wall']:8.3f} s")
+    return result
+
+
+def startup_time(repeat=5):
+    """
+    Best wall time of chromamature.py -h over repeat runs, including the
+    interpreter start up and imports.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, CLI, "-h"], stdout=subprocess.DEVNULL, check=True
+        )
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def halftime_mismatches(store, halftimes):
+    """
+    Number of curves whose halftime from store_halftimes differs between the
+    ruptures and fast backends, and from halftime on the curve on its own. Both
+    should be 0.
+    """
+    batched = {
+        backend: np.concatenate(list(values.values()))
+        for backend, values in halftimes.items()
+    }
+    single = []
+    for name in store["name"]:
+        x, grays = sample_curves(store, name)
+        for y in grays:
+            h = halftime(x, y)
+            single.append(np.nan if h is None or h is False else h)
+
+    def differ(a, b):
+        return int(np.sum(~np.isclose(a, b, equal_nan=True)))
+
+    return {
+        "fast": differ(batched["ruptures"], batched["fast"]),
+        "per_curve": differ(batched["ruptures"], np.array(single, dtype=np.float64)),
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except OSError:
+        return None
+
+
+def run_benchmark(
+    work_dir,
+    n_frames,
+    width,
+    height,
+    n_samples,
+    n_points,
+    workers,
+    roi_size=5,
+    drift=3,
+):
+    image_dir, coords_path = make_timelapse(
+        work_dir, n_frames, width, height, n_samples, n_points, drift=drift
+    )
+    total_points = n_samples * n_points
+    stages = {}
+
+    results = _timed(
+        stages, "process_images", process_images, image_dir, coords_path, 5, roi_size
+    )
+    # The same analysis on frames decoded as a single channel
+    _timed(
+        stages,
+        "process_images_gray",
+        process_images,
+        image_dir,
+        coords_path,
+        5,
+        roi_size,
+        decode="full_gray",
+    )
+    # Whole colonies instead of points, thousands of pixels per ROI
+    _timed(
+        stages,
+        "process_images_circles",
+        process_images,
+        image_dir,
+        os.path.join(work_dir, "circles.csv"),
+        5,
+        roi_size,
+    )
+    for backend in ("thread", "process"):
+        _timed(
+            stages,
+            f"process_images_parallel_{backend}",
+            process_images_parallel,
+            image_dir,
+            coords_path,
+            5,
+            roi_size,
+            backend=backend,
+            workers=workers,
+        )
+
+    # The threads share the ROI plan and every new shift goes through its caches
+    registration = load_registration(image_dir, work_dir)
+    registered = _timed(
+        stages,
+        "process_images_parallel_register",
+        process_images_parallel,
+        image_dir,
+        coords_path,
+        5,
+        roi_size,
+        backend="thread",
+        workers=workers,
+        registration=registration,
+    )
+    if registered is None:
+        raise RuntimeError("The registered analysis on the thread backend failed.")
+    stages["process_images_parallel_register"]["shifts"] = len(
+        {offset[:2] for offset in registration["offsets"].values()}
+    )
+
+    store = _timed(stages, "results_to_store", results_to_store, results)
+    backend_halftimes = {}
+    for backend in ("ruptures", "fast"):
+        halftimes = backend_halftimes[backend] = _timed(
+            stages,
+            f"halftimes_{backend}",
+            store_halftimes,
+            store,
+            workers=workers,
+            backend=backend,
+        )
+    mismatches = halftime_mismatches(store, backend_halftimes)
+    print(
+        f"{'halftime_mismatches':<34} fast {mismatches['fast']}, per curve {mismatches['per_curve']}"
+    )
+    data = [h[~np.isnan(h)] for h in halftimes.values()]
+    _timed(stages, "bootstrap", bootstrap_means, data, seed=0)
+
+    plot_dir = os.path.join(work_dir, "plots")
+    os.makedirs(os.path.join(plot_dir, "scatterplots"), exist_ok=True)
+    os.makedirs(os.path.join(plot_dir, "boxplots"), exist_ok=True)
+    _timed(
+        stages,
+        "render_plots",
+        render_plots,
+        store,
+        plot_dir,
+        halftime_data=(data, store["name"]),
+        dpi=100,
+        workers=workers,
+    )
+
+    stages["cli_help"] = {"wall": startup_time()}
+    print(f"{'cli_help':<34} {stages['cli_help']['wall']:8.3f} s")
+
+    # End to end through the CLI, including interpreter start up and imports
+    command = [
+        sys.executable,
+        CLI,
+        "-c",
+        coords_path,
+        "-o",
+        os.path.join(work_dir, "runs"),
+        "-ip",
+        image_dir,
+        "-t",
+        "5",
+        "-p",
+        "-b",
+        "process",
+        "--no_cache",
+        "--dpi",
+        "100",
+    ]
+    if workers:
+        command += ["-w", str(workers)]
+    _timed(stages, "end_to_end", subprocess.run, command, cwd=work_dir, check=True)
+
+    for name in stages:
+        if name.startswith("process_images"):
+            stages[name]["frames_per_s"] = n_frames / stages[name]["wall"]
+            # The circles have a different number of points per sample
+            if name != "process_images_circles":
+                stages[name]["points_per_s"] = (
+                    n_frames * total_points / stages[name]["wall"]
+                )
+        elif name.startswith("halftimes"):
+            stages[name]["points_per_s"] = total_points / stages[name]["wall"]
+
+    return {
+        "commit": _git_commit(),
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "config": {
+            "frames": n_frames,
+            "width": width,
+            "height": height,
+            "samples": n_samples,
+            "points": n_points,
+            "workers": workers,
+            "roi_size": roi_size,
+            "drift": drift,
+        },
+        "stages": stages,
+        "halftime_mismatches": mismatches,
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def compare(report, baseline):
+    """
+    Print the wall time of every stage relative to an earlier report.
+    """
+    print(f"\nCompared to {baseline.get('commit')} ({baseline.get('date')}):")
+    for name, stage in report["stages"].items():
+        old = baseline["stages"].get(name)
+        if old is None:
+            continue
+        ratio = stage["wall"] / old["wall"]
+        print(
+            f"{name:<34} {old['wall']:8.3f} s -> {stage['wall']:8.3f} s  ({ratio:.2f}x)"
+        )
+    if "peak_rss_mb" in baseline:
+        print(
+            f"{'peak_rss_mb':<34} {baseline['peak_rss_mb']:8.0f} MB -> {report['peak_rss_mb']:8.0f} MB"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Times every stage of the pipeline on a synthetic timelapse"
+    )
+    parser.add_argument(
+        "-f", "--frames", help="Number of frames", default=100, type=int
+    )
+    parser.add_argument("--width", help="Frame width", default=1920, type=int)
+    parser.add_argument("--height", help="Frame height", default=1080, type=int)
+    parser.add_argument(
+        "-s", "--samples", help="Number of samples", default=6, type=int
+    )
+    parser.add_argument(
+        "-n", "--points", help="Number of points per sample", default=20, type=int
+    )
+    parser.add_argument(
+        "-w", "--workers", help="Number of workers", default=None, type=int
+    )
+    parser.add_argument(
+        "-o", "--output", help="Write the report to this json file", default=None
+    )
+    parser.add_argument(
+        "--compare", help="Earlier json report to compare against", default=None
+    )
+    parser.add_argument(
+        "--drift",
+        help="Largest shift of a frame in pixels, tests the drift correction",
+        default=3,
+        type=int,
+    )
+    parser.add_argument(
+        "--keep", help="Directory to keep the synthetic timelapse in", default=None
+    )
+    parser.add_argument(
+        "--startup_budget",
+        help="Fail if chromamature.py -h takes longer than this many seconds",
+        default=STARTUP_BUDGET,
+        type=float,
+    )
+    parser.add_argument(
+        "--startup_only",
+        help="Only check the start up time of chromamature.py -h against the budget",
+        default=False,
+        action="store_true",
+    )
+    args = parser.parse_args()
+
+    if args.startup_only:
+        help_wall = startup_time()
+        print(f"{'cli_help':<34} {help_wall:8.3f} s")
+    else:
+        work_dir = args.keep or tempfile.mkdtemp(prefix="chromamature_bench_")
+        try:
+            report = run_benchmark(
+                work_dir,
+                args.frames,
+                args.width,
+                args.height,
+                args.samples,
+                args.points,
+                args.workers,
+                drift=args.drift,
+            )
+        finally:
+            if args.keep is None:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=2)
+
+        if args.compare:
+            with open(args.compare) as f:
+                compare(report, json.load(f))
+        help_wall = report["stages"]["cli_help"]["wall"]
+
+    if help_wall > args.startup_budget:
+        print(
+            f"\nchromamature.py -h took {help_wall:.3f} s, over the budget of {args.startup_budget} s."
+        )
+        sys.exit(1)
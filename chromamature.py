@@ -1,10 +1,98 @@
-from scripts.image_analysis import *
-from scripts.plots import *
-from scripts.stat_test import *
+from scripts.metrics import new_metrics, stage, count, write_metrics, profiled
 import argparse
 import os
+import sys
+import time
 import logging
 
+# cv2, pandas, scipy and matplotlib take seconds to import, so the modules of
+# every stage are imported in the functions that run it. -h and argument errors
+# don't load any of them and a run only loads what its stages need.
+
+logger = logging.getLogger(__name__)
+
+
+def make_run_dirs(output_path, plots=True):
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+    # A sweep, or a run with --plot_format none, draws no plots
+    if not plots:
+        return
+    if not os.path.exists(f"{output_path}/scatterplots"):
+        os.makedirs(f"{output_path}/scatterplots")
+    if not os.path.exists(f"{output_path}/boxplots"):
+        os.makedirs(f"{output_path}/boxplots")
+
+
+def write_bootstrap_results(path, label, conf_interval):
+    with open(path, "w") as f:
+        # Write header
+        f.write("name, mean, conf_in\n")
+        for lab, ci in zip(label, conf_interval):
+            # ci is structured as ((lower, upper), mean)
+            conf_values, mean_value = ci
+            conf_str = f"[{conf_values[0]}, {conf_values[1]}]"
+            f.write(f"{lab}, {mean_value}, {conf_str}\n")
+
+
+def report_run(
+    image_results,
+    output_path,
+    workers=None,
+    segmentation="ruptures",
+    seed=0,
+    ci_method="percentile",
+    yrange=None,
+    dpi=300,
+    plot_format="png",
+    metrics=None,
+    executor=None,
+    signal="gray",
+):
+    """
+    Halftimes, bootstrap intervals and plots of a results store, written to the
+    run directory output_path. signal is the feature the store holds instead of
+    the gray value, for the plot labels. Returns the halftimes, labels and
+    confidence intervals of every sample.
+    """
+    from scripts.plots import boxplot_data, scatterplot_range, render_plots
+
+    logger = logging.getLogger(__name__)
+    logger.info("Image analysis complete, calculating halftimes.")
+
+    data, label, conf_interval = boxplot_data(
+        image_results,
+        workers=workers,
+        backend=segmentation,
+        seed=seed,
+        ci_method=ci_method,
+        metrics=metrics,
+        executor=executor,
+    )
+
+    logger.info("Generating plots.")
+
+    with stage(metrics, "plotting"):
+        if yrange is None:
+            yrange = scatterplot_range(image_results)
+
+        render_plots(
+            image_results,
+            output_path,
+            yrange=yrange,
+            halftime_data=(data, label),
+            dpi=dpi,
+            fmt=plot_format,
+            workers=workers,
+            executor=executor,
+            signal=signal,
+        )
+
+    write_bootstrap_results(
+        f"{output_path}/bootstrap_results.txt", label, conf_interval
+    )
+    return data, label, conf_interval
+
 
 def main(
     coords_path,
@@ -12,14 +100,52 @@ def main(
     im_path,
     run_name,
     parallel,
+    backend,
+    workers,
     time_interval,
     roi_size,
+    decode,
     yrange,
     interval_size,
     votes,
     jump_size,
-    clean_data,
+    clean,
+    use_cache=True,
+    cache_dir=None,
+    cache_size=1024,
+    watch=False,
+    poll_interval=10,
+    idle_timeout=None,
+    export_results_csv=True,
+    segmentation="ruptures",
+    seed=0,
+    ci_method="percentile",
+    dpi=300,
+    plot_format="png",
+    profiler=None,
+    stack=None,
+    stack_margin=100,
+    stack_color=False,
+    sweep_roi=None,
+    sweep_window=None,
+    sweep_jump=None,
+    quality_check=False,
+    timestamps="auto",
+    time_pattern=None,
+    register=False,
+    features=None,
+    signal="gray",
+    color_decode=False,
+    reset_cache=False,
 ):
+    from scripts.image_analysis import (
+        process_images,
+        process_images_parallel,
+        gray_decode,
+    )
+    from scripts.cache import open_cache, close_cache, clear_cache
+    from scripts.timeline import build_timeline
+    from scripts.results import open_writer, close_writer, save_store, signal_store
 
     logging.getLogger("matplotlib").setLevel(logging.WARNING)
 
@@ -32,68 +158,248 @@ def main(
     )
 
     logger.info("Starting main function.")
+    if cache_dir is None:
+        cache_dir = f"{output_path}/.chromamature_cache"
     output_path = f"{output_path}/{run_name}"
 
-    if not os.path.exists(output_path):
-        os.makedirs(output_path)
-    if not os.path.exists(f"{output_path}/scatterplots"):
-        os.makedirs(f"{output_path}/scatterplots")
-    if not os.path.exists(f"{output_path}/boxplots"):
-        os.makedirs(f"{output_path}/boxplots")
-
-    try:
-        if parallel:
-            logger.info("Running image analysis in parallel mode.")
-            image_results = process_images_parallel(
-                im_path, coords_path, time_interval, roi_size
-            )
-        else:
-            logger.info("Running image analysis in sequential mode.")
-            image_results = process_images(
-                im_path, coords_path, time_interval, roi_size
-            )
-
-        logger.info("Image analysis complete, writing results to csv.")
-        image_results = csv_writer(image_results, output_path)
-
-        # Clean data not viable
-        if clean_data:
-            image_results = clean_data(
-                image_results,
-                interval_size,
-                votes,
-                time_interval,
-                interval_jump=jump_size,
-            )
-
-        logger.info("Image analysis complete, generating plots.")
-
-        if yrange is None:
-            yrange = scatterplot_range(image_results)
-
-        for name in image_results["Name"].unique():
-            scatterplot(
-                image_results,
-                name,
-                output_path=f"{output_path}/scatterplots",
-                yrange=yrange,
-            )
-
-        label, conf_interval = boxplot(
-            image_results, output_path=f"{output_path}/boxplots"
+    sweep = bool(sweep_roi or sweep_window or sweep_jump)
+    make_run_dirs(output_path, plots=not sweep and plot_format != "none")
+    if register and (watch or sweep or stack is not None):
+        logger.warning(
+            "Drift correction is only used in the sequential and parallel analysis."
         )
+        register = False
+    if (features or signal != "gray") and (watch or sweep or stack is not None):
+        logger.warning(
+            "Color features are only measured in the sequential and parallel analysis."
+        )
+        features, signal = None, "gray"
+    if signal != "gray":
+        features = list(features or []) + [signal]
+    # Only gray values are needed, so the pictures are decoded as a single channel
+    if not color_decode and not stack_color:
+        decode = gray_decode(decode, features)
+    cache = open_cache(cache_dir) if use_cache and not sweep else None
+    if cache is not None and reset_cache:
+        logger.info(f"Clearing the frame cache in {cache_dir}.")
+        clear_cache(cache)
+    writer = None
+    metrics = new_metrics()
+    metrics["status"] = "running"
+    run_start = time.perf_counter()
 
-        with open(f"{output_path}/bootstrap_results.txt", "w") as f:
-            # Write header
-            f.write("name, mean, conf_in\n")
-            for lab, ci in zip(label, conf_interval):
-                # ci is structured as ((lower, upper), mean)
-                conf_values, mean_value = ci
-                conf_str = f"[{conf_values[0]}, {conf_values[1]}]"
-                f.write(f"{lab}, {mean_value}, {conf_str}\n")
+    try:
+        with profiled(profiler, output_path):
+            timeline = None
+            if not watch:
+                with stage(metrics, "timeline"):
+                    timeline, metrics["timeline"] = build_timeline(
+                        im_path,
+                        time_interval,
+                        timestamps,
+                        time_pattern,
+                        cache_dir if use_cache else None,
+                    )
+
+            if sweep:
+                from scripts.sweep import run_sweep
+
+                logger.info("Running a parameter sweep.")
+                run_sweep(
+                    im_path,
+                    coords_path,
+                    output_path,
+                    time_interval,
+                    roi_sizes=sweep_roi or [roi_size],
+                    windows=sweep_window or [11],
+                    jumps=sweep_jump or [5],
+                    decode=decode,
+                    workers=workers,
+                    backend=segmentation,
+                    seed=seed,
+                    ci_method=ci_method,
+                    metrics=metrics,
+                    timeline=timeline,
+                )
+            else:
+                skip = None
+                if quality_check and not watch:
+                    from scripts.quality import prefilter
+
+                    logger.info("Checking the quality of the pictures.")
+                    with stage(metrics, "prefilter"):
+                        skip = prefilter(im_path, output_path, workers, metrics)
+
+                registration = None
+                if register:
+                    from scripts.registration import (
+                        load_registration,
+                        save_registration,
+                    )
+
+                    logger.info("Registering the pictures against the first one.")
+                    with stage(metrics, "registration"):
+                        registration = load_registration(
+                            im_path, output_path, decode, skip
+                        )
+
+                # The rows are written as the frames are analysed
+                if not watch:
+                    writer = open_writer(output_path, features, export_results_csv)
+
+                with stage(metrics, "analysis"):
+                    if watch:
+                        from scripts.watch import watch_images
+
+                        logger.info("Running image analysis in watch mode.")
+                        image_results = watch_images(
+                            im_path,
+                            coords_path,
+                            output_path,
+                            time_interval,
+                            roi_size,
+                            decode=decode,
+                            poll_interval=poll_interval,
+                            idle_timeout=idle_timeout,
+                            cache=cache,
+                            backend=segmentation,
+                            seed=seed,
+                            ci_method=ci_method,
+                        )
+                    elif stack is not None:
+                        from scripts.stack import ensure_stack
+
+                        logger.info(
+                            f"Running image analysis on the frame stack {stack}."
+                        )
+                        with stage(metrics, "stack"):
+                            ensure_stack(
+                                stack,
+                                im_path,
+                                coords_path,
+                                roi_size,
+                                decode,
+                                stack_margin,
+                                stack_color,
+                                workers,
+                                metrics,
+                            )
+                        image_results = process_images(
+                            im_path,
+                            coords_path,
+                            time_interval,
+                            roi_size,
+                            metrics=metrics,
+                            stack=stack,
+                            skip=skip,
+                            timeline=timeline,
+                            writer=writer,
+                        )
+                    elif parallel:
+                        logger.info(
+                            f"Running image analysis in parallel mode ({backend})."
+                        )
+                        image_results = process_images_parallel(
+                            im_path,
+                            coords_path,
+                            time_interval,
+                            roi_size,
+                            backend=backend,
+                            workers=workers,
+                            decode=decode,
+                            cache=cache,
+                            metrics=metrics,
+                            skip=skip,
+                            timeline=timeline,
+                            registration=registration,
+                            features=features,
+                            writer=writer,
+                        )
+                    else:
+                        logger.info("Running image analysis in sequential mode.")
+                        image_results = process_images(
+                            im_path,
+                            coords_path,
+                            time_interval,
+                            roi_size,
+                            decode=decode,
+                            cache=cache,
+                            metrics=metrics,
+                            skip=skip,
+                            timeline=timeline,
+                            registration=registration,
+                            features=features,
+                            writer=writer,
+                        )
+
+                    if cache is not None:
+                        close_cache(cache, cache_size)
+                        cache = None
+
+                    if registration is not None:
+                        save_registration(registration, output_path, metrics)
+
+                logger.info("Image analysis complete, writing results.")
+                with stage(metrics, "write_results"):
+                    if writer is not None:
+                        analysed = image_results is not None
+                        image_results = close_writer(writer)
+                        writer = None
+                        if not analysed:
+                            raise RuntimeError("Image analysis failed.")
+                    elif image_results is None:
+                        raise RuntimeError("Image analysis failed.")
+
+                    save_store(image_results, output_path)
+                count(metrics, "frames", len(image_results["time"]))
+
+                if signal != "gray":
+                    logger.info(f"Using {signal} as the signal.")
+                    image_results = signal_store(image_results, signal)
+
+                if clean:
+                    from scripts.cleaning import clean_data
+
+                    with stage(metrics, "cleaning"):
+                        image_results = clean_data(
+                            image_results,
+                            interval_size,
+                            votes,
+                            interval_jump=jump_size,
+                            metrics=metrics,
+                        )
+
+                report_run(
+                    image_results,
+                    output_path,
+                    workers=workers,
+                    segmentation=segmentation,
+                    seed=seed,
+                    ci_method=ci_method,
+                    yrange=yrange,
+                    dpi=dpi,
+                    plot_format=plot_format,
+                    metrics=metrics,
+                    signal=signal,
+                )
+
+        metrics["status"] = "finished"
 
     except Exception as e:
         logger.error(f"Error: {e}", exc_info=True)
+        metrics["status"] = "failed"
+        metrics["error"] = repr(e)
+    finally:
+        if cache is not None:
+            close_cache(cache, cache_size)
+        if writer is not None:
+            # Keeps the rows of the frames analysed before the error
+            close_writer(writer)
+
+        metrics["total_wall"] = time.perf_counter() - run_start
+        write_metrics(metrics, f"{output_path}/run_metrics.json")
+
+    return metrics
 
 
 if __name__ == "__main__":
@@ -142,10 +448,26 @@ if __name__ == "__main__":
         action="store_true",
     )
 
+    parser.add_argument(
+        "-b",
+        "--backend",
+        help="Executor used with -p, threads or processes (processes scale better on many cores)",
+        default="thread",
+        choices=["thread", "process"],
+    )
+
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="Number of workers used with -p, defaults to the number of cores",
+        default=None,
+        type=int,
+    )
+
     parser.add_argument(
         "-t",
         "--time",
-        help="Time interval between the pictures",
+        help="Time interval between the pictures in minutes, used when the pictures have no timestamps (see --timestamps)",
         required=True,
         type=int,
     )
@@ -158,6 +480,29 @@ if __name__ == "__main__":
         type=int,
     )
 
+    parser.add_argument(
+        "-d",
+        "--decode",
+        help="Decode the pictures at full resolution or at 1/2, 1/4 or 1/8 of it. The reduced modes are 2-4 times faster, see the README for their tolerance against full resolution. Without color features the pictures are decoded in grayscale, the _gray modes force it",
+        default="full",
+        choices=[
+            "full",
+            "reduced2",
+            "reduced4",
+            "reduced8",
+            "full_gray",
+            "reduced2_gray",
+            "reduced4_gray",
+            "reduced8_gray",
+        ],
+    )
+    parser.add_argument(
+        "--color_decode",
+        help="Decode the pictures in color even if only gray values are measured, gives exactly the gray values of cvtColor",
+        default=False,
+        action="store_true",
+    )
+
     parser.add_argument(
         "-yr",
         "--yrange",
@@ -168,12 +513,17 @@ if __name__ == "__main__":
     parser.add_argument(
         "-iz",
         "--interval_size",
-        help="The interval size when cleaning the data",
+        help="Number of pictures in the reading frame when cleaning the data",
         default=20,
+        type=int,
     )
 
     parser.add_argument(
-        "-v", "--votes", help="Total amount of votes for it to be an outlier", default=4
+        "-v",
+        "--votes",
+        help="Total amount of votes for it to be an outlier",
+        default=4,
+        type=int,
     )
 
     parser.add_argument(
@@ -181,29 +531,264 @@ if __name__ == "__main__":
         "--jump_size",
         help="Size of the jump in relation of the readingframe for data cleaning, e.g -jz 5 will result in a 20%% jump of the reading frame relative to the length of the reading frame",
         default=5,
+        type=int,
     )
 
     parser.add_argument(
         "-cd",
         "--clean_data",
-        help="Cleans data (not recommended yet)",
+        help="Replace outliers in the gray values before calculating the halftimes, found by voting over a sliding reading frame (see -iz, -v and -jz)",
         default=False,
         action="store_true",
     )
 
+    parser.add_argument(
+        "--no_cache",
+        help="Analyse every picture again instead of reusing cached results of unchanged pictures",
+        default=False,
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--cache_dir",
+        help="Directory of the frame cache, defaults to .chromamature_cache in the output directory",
+        default=None,
+        type=str,
+    )
+
+    parser.add_argument(
+        "--cache_size",
+        help="Maximum size of the frame cache in MB, least recently used frames are evicted first",
+        default=1024,
+        type=int,
+    )
+
+    parser.add_argument(
+        "--clear_cache",
+        help="Empty the frame cache before the analysis, so every picture is analysed again and the new results are cached",
+        default=False,
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--watch",
+        help="Analyse the pictures as they are written to the image directory, results.csv and halftimes_live.txt are updated while the timelapse runs. Stop with Ctrl-C or --idle_timeout",
+        default=False,
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--poll",
+        help="Seconds between checks for new pictures in watch mode",
+        default=10,
+        type=float,
+    )
+
+    parser.add_argument(
+        "--idle_timeout",
+        help="Stop watch mode when no new picture has arrived for this many minutes",
+        default=None,
+        type=float,
+    )
+
+    parser.add_argument(
+        "--no_csv",
+        help="Only write the results to results.npz and skip the results.csv export",
+        default=False,
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "-s",
+        "--segmentation",
+        help="How the plateau of each curve is found: ruptures Binseg (default) or fast, the built-in binary segmentation. Both fit a line to every segment and give the same halftimes, fast is about 10 times faster",
+        default="ruptures",
+        choices=["ruptures", "fast"],
+    )
+
+    parser.add_argument(
+        "--seed",
+        help="Seed of the bootstrap resampling, the same seed gives the same confidence intervals",
+        default=0,
+        type=int,
+    )
+
+    parser.add_argument(
+        "--ci",
+        help="Bootstrap confidence interval, percentile (default) or bca (bias corrected and accelerated)",
+        default="percentile",
+        choices=["percentile", "bca"],
+    )
+
+    parser.add_argument(
+        "--dpi",
+        help="Resolution of the saved plots",
+        default=300,
+        type=int,
+    )
+
+    parser.add_argument(
+        "--plot_format",
+        help="File format of the plots, or none to skip plotting",
+        default="png",
+        choices=["png", "svg", "none"],
+    )
+
+    parser.add_argument(
+        "--profile",
+        help="Profile the run with cProfile or pyinstrument, the report is saved in the run directory",
+        default=None,
+        choices=["cprofile", "pyinstrument"],
+    )
+
+    parser.add_argument(
+        "--stack",
+        help="Decode the pictures once into a memory mapped frame stack in this directory and read the ROIs from it. Reruns with other roi sizes or coordinates reuse the stack as long as the pictures are unchanged",
+        default=None,
+        type=str,
+    )
+
+    parser.add_argument(
+        "--stack_margin",
+        help="Crop the frame stack to the coordinates plus this many pixels, -1 keeps the whole pictures",
+        default=100,
+        type=int,
+    )
+
+    parser.add_argument(
+        "--stack_color",
+        help="Keep the color channels in the frame stack instead of storing it in grayscale",
+        default=False,
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--sweep_roi",
+        help="Sweep mode, compare these roi sizes (e.g. --sweep_roi 3 5 8) from a single decode of every picture. The halftimes and bootstrap intervals of every combination with --sweep_window and --sweep_jump are written to sweep_results.csv instead of the usual results",
+        nargs="+",
+        default=None,
+        type=int,
+    )
+
+    parser.add_argument(
+        "--sweep_window",
+        help="Sweep mode, compare these savgol window lengths (odd, default 11)",
+        nargs="+",
+        default=None,
+        type=int,
+    )
+
+    parser.add_argument(
+        "--sweep_jump",
+        help="Sweep mode, compare these breakpoint jumps of the segmentation (default 5)",
+        nargs="+",
+        default=None,
+        type=int,
+    )
+
+    parser.add_argument(
+        "--prefilter",
+        help="Check every picture with cheap statistics first and skip truncated, dark, flash exposed or disturbed pictures. The skipped pictures and the reason are written to skipped_frames.csv (not in watch mode)",
+        default=False,
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--timestamps",
+        help="Where the time of every picture comes from: the EXIF capture time, the filename (with --time_pattern), the -t interval, or auto (default), the first of these that the pictures have. Not used in watch mode",
+        default="auto",
+        choices=["auto", "exif", "filename", "interval"],
+    )
+
+    parser.add_argument(
+        "--time_pattern",
+        help="strptime pattern of the filenames without extension, e.g. IMG_%%Y%%m%%d_%%H%%M%%S",
+        default=None,
+        type=str,
+    )
+
+    parser.add_argument(
+        "--register",
+        help="Correct the drift of the plate: every picture is registered against the first one and the ROIs are moved with it. The offsets are saved in registration.csv and reused by later runs (not in watch, stack or sweep mode)",
+        default=False,
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--features",
+        help="Color features measured for every ROI next to the gray value and stored as extra columns: blue, green, red, hue, saturation, value, lightness, lab_a, lab_b, gray, or any of these with _std for the standard deviation (e.g. --features saturation hue gray_std)",
+        nargs="+",
+        default=None,
+        type=str,
+    )
+
+    parser.add_argument(
+        "--signal",
+        help="Feature used for the halftimes, cleaning and plots instead of the gray value, e.g. saturation for samples whose color change doesn't show in grayscale",
+        default="gray",
+        type=str,
+    )
+
     args = parser.parse_args()
 
-    main(
+    if args.jump_size < 1:
+        parser.error("The jump size -jz must be at least 1.")
+    if args.votes < 1:
+        parser.error("The number of votes -v must be at least 1.")
+
+    from scripts.image_analysis import parse_features
+
+    try:
+        features = parse_features((args.features or []) + [args.signal])
+    except ValueError as e:
+        parser.error(str(e))
+    if features != ["gray"] and args.decode.endswith("_gray"):
+        parser.error(f"Color features need a color decode mode, not {args.decode}.")
+
+    metrics = main(
         coords_path=args.coords,
         output_path=args.output,
         im_path=args.impath,
         run_name=args.name,
         parallel=args.parallel,
+        backend=args.backend,
+        workers=args.workers,
         time_interval=args.time,
         roi_size=args.roi_size,
+        decode=args.decode,
         yrange=args.yrange,
         jump_size=args.jump_size,
         votes=args.votes,
         interval_size=args.interval_size,
-        clean_data=args.clean_data,
+        clean=args.clean_data,
+        use_cache=not args.no_cache,
+        cache_dir=args.cache_dir,
+        cache_size=args.cache_size,
+        watch=args.watch,
+        poll_interval=args.poll,
+        idle_timeout=None if args.idle_timeout is None else args.idle_timeout * 60,
+        export_results_csv=not args.no_csv,
+        segmentation=args.segmentation,
+        seed=args.seed,
+        ci_method=args.ci,
+        dpi=args.dpi,
+        plot_format=args.plot_format,
+        profiler=args.profile,
+        stack=args.stack,
+        stack_margin=args.stack_margin,
+        stack_color=args.stack_color,
+        sweep_roi=args.sweep_roi,
+        sweep_window=args.sweep_window,
+        sweep_jump=args.sweep_jump,
+        quality_check=args.prefilter,
+        timestamps=args.timestamps,
+        time_pattern=args.time_pattern,
+        register=args.register,
+        features=args.features,
+        signal=args.signal,
+        color_decode=args.color_decode,
+        reset_cache=args.clear_cache,
     )
+
+    if metrics["status"] == "failed":
+        sys.exit(1)
@@ -0,0 +1,155 @@
+from scripts.regions import (
+    detect_regions,
+    region_points,
+    region_masks,
+    save_regions,
+    overview,
+)
+import argparse
+import os
+import sys
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def run_detection(
+    image_path,
+    output_path,
+    decode="reduced8",
+    min_area=0.001,
+    max_area=0.25,
+    smooth=3,
+    lightness=0.25,
+    n_points=20,
+    roi_size=5,
+    seed=0,
+):
+    """
+    Detect the sample regions in a reference picture and write regions.png,
+    regions.csv, a coords.csv with n_points points per region, a masks.csv with
+    one mask ROI per region and regions_overview.jpg to output_path. Returns the
+    regions DataFrame.
+    """
+    labels, regions = detect_regions(
+        image_path,
+        decode=decode,
+        min_area=min_area,
+        max_area=max_area,
+        smooth=smooth,
+        lightness=lightness,
+    )
+    save_regions(output_path, labels, regions)
+    region_points(labels, regions, n_points, roi_size, seed).to_csv(
+        os.path.join(output_path, "coords.csv"), index=False
+    )
+    region_masks(regions).to_csv(os.path.join(output_path, "masks.csv"), index=False)
+    overview(
+        image_path,
+        labels,
+        regions,
+        os.path.join(output_path, "regions_overview.jpg"),
+        decode,
+    )
+    return regions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Finds the samples in a reference picture and writes their regions and a coords csv"
+    )
+    parser.add_argument(
+        "-i",
+        "--image",
+        help="Reference picture where the developed colors are clearly visible",
+        required=True,
+        type=str,
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="Directory for regions.png, regions.csv, coords.csv, masks.csv and regions_overview.jpg",
+        required=True,
+        type=str,
+    )
+    parser.add_argument(
+        "-d",
+        "--decode",
+        help="Resolution the regions are detected at",
+        default="reduced8",
+        choices=["full", "reduced2", "reduced4", "reduced8"],
+    )
+    parser.add_argument(
+        "--min_area",
+        help="Smallest region as a fraction of the picture",
+        default=0.001,
+        type=float,
+    )
+    parser.add_argument(
+        "--max_area",
+        help="Largest region as a fraction of the picture",
+        default=0.25,
+        type=float,
+    )
+    parser.add_argument(
+        "--smooth",
+        help="Size in detection pixels of the opening and closing of the regions",
+        default=3,
+        type=int,
+    )
+    parser.add_argument(
+        "--lightness",
+        help="Weight of lightness differences against color differences, raise it for samples that only darken",
+        default=0.25,
+        type=float,
+    )
+    parser.add_argument(
+        "-n",
+        "--points",
+        help="Number of points per region in coords.csv",
+        default=20,
+        type=int,
+    )
+    parser.add_argument(
+        "-r",
+        "--roi_size",
+        help="Roi size of the analysis, the points are kept this far from the edge of their region",
+        default=5,
+        type=int,
+    )
+    parser.add_argument(
+        "--seed",
+        help="Seed of the point sampling",
+        default=0,
+        type=int,
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    )
+
+    try:
+        regions = run_detection(
+            args.image,
+            args.output,
+            decode=args.decode,
+            min_area=args.min_area,
+            max_area=args.max_area,
+            smooth=args.smooth,
+            lightness=args.lightness,
+            n_points=args.points,
+            roi_size=args.roi_size,
+            seed=args.seed,
+        )
+    except Exception as e:
+        logger.error(f"Error: {e}", exc_info=True)
+        sys.exit(1)
+
+    if not len(regions):
+        logger.warning(
+            "No regions found, try a lower --min_area or a higher --max_area."
+        )
+        sys.exit(1)
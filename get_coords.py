@@ -1,6 +1,7 @@
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
-from PIL import Image, ImageTk
+from PIL import Image, ImageOps, ImageTk
+import numpy as np
 import pandas as pd
 import os
 import sys
@@ -14,12 +15,19 @@ class BacteriaColorAnalysisApp:
         # Initialize variables
         self.sample_name_var = tk.StringVar()
         self.color_var = tk.StringVar()
+        # Roi size of the analysis (-r), the points sampled in the regions are
+        # kept this far from their edges
+        self.roi_size_var = tk.StringVar(value="5")
         self.image_path = ""
         self.image = None
         self.photo = None
         self.scale_ratio = 1.0
         self.max_image_size = (800, 600)  # Adjust as needed
         self.selections = []  # To store recent selections
+        # Regions of detect_regions.py, the GUI only names and discards them
+        self.regions_path = None
+        self.labels = None
+        self.regions = None
 
         # Determine the appropriate resampling filter
         self.resample_filter = self.get_resample_filter()
@@ -65,11 +73,22 @@ class BacteriaColorAnalysisApp:
         self.color_entry = tk.Entry(control_frame, textvariable=self.color_var)
         self.color_entry.grid(row=1, column=1, padx=5, pady=5)
 
+        tk.Label(control_frame, text="Roi Size:").grid(
+            row=2, column=0, padx=5, pady=5, sticky=tk.E
+        )
+        self.roi_size_entry = tk.Entry(control_frame, textvariable=self.roi_size_var)
+        self.roi_size_entry.grid(row=2, column=1, padx=5, pady=5)
+
         select_image_button = tk.Button(
             control_frame, text="Select Image", command=self.select_image
         )
         select_image_button.grid(row=0, column=2, rowspan=2, padx=10, pady=5)
 
+        load_regions_button = tk.Button(
+            control_frame, text="Load Regions", command=self.load_regions
+        )
+        load_regions_button.grid(row=0, column=3, rowspan=2, padx=10, pady=5)
+
         # Image Frame Components
         self.canvas = tk.Canvas(
             image_frame,
@@ -113,8 +132,79 @@ class BacteriaColorAnalysisApp:
         )
         if file_path:
             self.image_path = file_path
+            self.regions = None
             self.load_and_display_image()
 
+    def load_regions(self):
+        """
+        Load the regions that detect_regions.py found in the selected image. A
+        click on a region gives it the current sample name and color.
+        """
+        if not self.image_path:
+            messagebox.showwarning("No Image", "Please select an image first.")
+            return
+        path = filedialog.askdirectory(title="Select Regions Directory")
+        if not path:
+            return
+        try:
+            from scripts.regions import load_regions
+
+            self.labels, self.regions = load_regions(path)
+            self.regions_path = path
+            self.display_regions()
+            self.update_treeview()
+        except Exception as e:
+            self.regions = None
+            messagebox.showerror("Error", f"Failed to load regions: {e}")
+
+    def display_regions(self):
+        # The labels are in the orientation OpenCV decodes the picture in, so the
+        # EXIF rotation is applied to the displayed image too
+        pil_image = ImageOps.exif_transpose(Image.open(self.image_path))
+        pil_image = pil_image.convert("RGB")
+        pil_image.thumbnail(self.max_image_size, self.resample_filter)
+        labels = Image.fromarray(self.labels.astype(np.int32)).resize(
+            pil_image.size, Image.NEAREST
+        )
+        labels = np.asarray(labels)
+
+        # Outline every region in red
+        edge = np.zeros(labels.shape, dtype=bool)
+        edge[1:] |= labels[1:] != labels[:-1]
+        edge[:, 1:] |= labels[:, 1:] != labels[:, :-1]
+        pixels = np.array(pil_image)
+        pixels[edge] = (255, 0, 0)
+        pil_image = Image.fromarray(pixels)
+
+        self.photo = ImageTk.PhotoImage(pil_image)
+        self.canvas.delete("all")
+        self.canvas.config(width=pil_image.width, height=pil_image.height)
+        self.canvas.create_image(0, 0, anchor=tk.NW, image=self.photo)
+        self.canvas.image = self.photo  # Prevent garbage collection
+
+        self.label_ratio = (
+            self.labels.shape[1] / pil_image.width,
+            self.labels.shape[0] / pil_image.height,
+        )
+        for region in self.regions.itertuples():
+            self.canvas.create_text(
+                region.y / region.scale / self.label_ratio[0],
+                region.x / region.scale / self.label_ratio[1],
+                text=region.name,
+                fill="red",
+            )
+
+    def name_region(self, event, sample_name, color):
+        row = min(int(event.y * self.label_ratio[1]), self.labels.shape[0] - 1)
+        col = min(int(event.x * self.label_ratio[0]), self.labels.shape[1] - 1)
+        label = self.labels[row, col]
+        if label == 0:
+            return
+        index = self.regions.index[self.regions["label"] == label]
+        self.regions.loc[index, ["name", "color"]] = (sample_name, color)
+        self.display_regions()
+        self.update_treeview()
+
     def load_and_display_image(self):
         try:
             pil_image = Image.open(self.image_path)
@@ -145,6 +235,10 @@ class BacteriaColorAnalysisApp:
             )
             return
 
+        if self.regions is not None:
+            self.name_region(event, sample_name, color)
+            return
+
         # Calculate original coordinates
         orig_x = int(event.x * self.scale_ratio[0])
         orig_y = int(event.y * self.scale_ratio[1])
@@ -174,6 +268,12 @@ class BacteriaColorAnalysisApp:
         # Clear existing items
         for item in self.tree.get_children():
             self.tree.delete(item)
+        if self.regions is not None:
+            for region in self.regions.itertuples():
+                self.tree.insert(
+                    "", tk.END, values=(region.name, region.color, region.x, region.y)
+                )
+            return
         # Insert recent selections
         for sel in self.selections[-20:]:  # Changed from 10 to 20
             self.tree.insert(
@@ -187,6 +287,14 @@ class BacteriaColorAnalysisApp:
             return
         item = selected_item[0]
         values = self.tree.item(item, "values")
+        if self.regions is not None:
+            # Discarded regions become background
+            label = self.regions["label"].iloc[self.tree.index(item)]
+            self.labels[self.labels == label] = 0
+            self.regions = self.regions[self.regions["label"] != label]
+            self.display_regions()
+            self.update_treeview()
+            return
         # Find and remove the selection from the list
         for sel in self.selections:
             if (sel["name"], sel["color"], str(sel["x"]), str(sel["y"])) == values:
@@ -214,7 +322,27 @@ class BacteriaColorAnalysisApp:
         df.to_csv("data.csv", index=False)
 
     def save_and_exit(self):
-        # If any final saving is needed, perform here. Currently, selections are saved immediately.
+        # Manual selections are saved immediately, named regions are written to
+        # their directory with a coords.csv of points sampled in them and a
+        # masks.csv that measures the whole regions
+        if self.regions is not None:
+            from scripts.regions import save_regions, region_points, region_masks
+
+            try:
+                roi_size = int(self.roi_size_var.get())
+            except ValueError:
+                messagebox.showwarning(
+                    "Invalid Roi Size", "Please enter the roi size as a whole number."
+                )
+                return
+
+            save_regions(self.regions_path, self.labels, self.regions)
+            region_points(self.labels, self.regions, roi_size=roi_size).to_csv(
+                os.path.join(self.regions_path, "coords.csv"), index=False
+            )
+            region_masks(self.regions).to_csv(
+                os.path.join(self.regions_path, "masks.csv"), index=False
+            )
         self.root.destroy()
 
 
@@ -0,0 +1,110 @@
+import os
+import time
+import sqlite3
+import hashlib
+import numpy as np
+import pandas as pd
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Per frame cache of the ROI means. A frame is identified by its path, mtime and
+# size together with the coords file (and its ROI masks), roi size and decode
+# mode, so a changed picture or analysis setting never hits an old entry. Old
+# entries are evicted least recently used first when the cache grows over its
+# size limit.
+
+
+def open_cache(cache_dir):
+    logger.info(f"Opening frame cache in {cache_dir}.")
+    os.makedirs(cache_dir, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(cache_dir, "frames.sqlite"))
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS frames "
+        "(key TEXT PRIMARY KEY, value BLOB, size INTEGER, used REAL)"
+    )
+    return conn
+
+
+def close_cache(conn, max_size_mb=1024):
+    evict(conn, max_size_mb)
+    conn.commit()
+    conn.close()
+
+
+def coords_digest(coordinates):
+    """
+    Hash of the coords file (or DataFrame) the ROI plan is built from, and of the
+    mask images of its shaped ROIs.
+    """
+    if isinstance(coordinates, str):
+        with open(coordinates, "rb") as f:
+            data = f.read()
+        df = pd.read_csv(coordinates)
+        base = os.path.dirname(os.path.abspath(coordinates))
+    else:
+        data = coordinates.to_csv(index=False).encode()
+        df = coordinates
+        base = os.getcwd()
+
+    digest = hashlib.sha1(data)
+    if "mask" in df.columns:
+        for mask in sorted(df["mask"].dropna().astype(str).unique()):
+            with open(os.path.join(base, mask), "rb") as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+def analysis_key(coordinates, roi_size, decode="full", reference=None, features=None):
+    # Registered means also depend on the reference frame of the drift correction
+    key = f"{coords_digest(coordinates)}|{roi_size}|{decode}"
+    if reference is not None:
+        key += f"|{reference}"
+    if features is not None and list(features) != ["gray"]:
+        key += f"|{','.join(features)}"
+    return key
+
+
+def frame_key(image_path, analysis):
+    stat = os.stat(image_path)
+    key = f"{os.path.abspath(image_path)}|{stat.st_mtime_ns}|{stat.st_size}|{analysis}"
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def cache_get(conn, key):
+    row = conn.execute("SELECT value FROM frames WHERE key = ?", (key,)).fetchone()
+    if row is None:
+        return None
+
+    conn.execute("UPDATE frames SET used = ? WHERE key = ?", (time.time(), key))
+    return np.frombuffer(row[0], dtype=np.float64).copy()
+
+
+def cache_put(conn, key, values):
+    data = np.asarray(values, dtype=np.float64).tobytes()
+    conn.execute(
+        "INSERT OR REPLACE INTO frames VALUES (?, ?, ?, ?)",
+        (key, data, len(data), time.time()),
+    )
+
+
+def evict(conn, max_size_mb):
+    """
+    Drop the least recently used entries until the cache fits in max_size_mb.
+    """
+    max_size = max_size_mb * 1024 * 1024
+    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM frames").fetchone()[0]
+    if total <= max_size:
+        return
+
+    df = pd.read_sql_query("SELECT key, size FROM frames ORDER BY used", conn)
+    n_drop = int(np.searchsorted(np.cumsum(df["size"]), total - max_size) + 1)
+    conn.executemany(
+        "DELETE FROM frames WHERE key = ?", [(k,) for k in df["key"][:n_drop]]
+    )
+    logger.info(f"Evicted {n_drop} frames from the cache.")
+
+
+def clear_cache(conn):
+    conn.execute("DELETE FROM frames")
+    conn.commit()
@@ -0,0 +1,126 @@
+import warnings
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+import logging
+from scripts.results import as_store
+from scripts.metrics import count
+
+logger = logging.getLogger(__name__)
+
+# Outlier cleaning with a sliding reading frame. A frame of interval_size time
+# points slides over every curve in jumps of interval_size / interval_jump. In
+# every frame a line is fitted to the curve and the points far from it, compared
+# to the median absolute residual, get a vote. Points with at least votes votes
+# are outliers and are replaced by interpolating their neighbours in time.
+
+# Residuals above this many robust standard deviations are voted for
+MAD_THRESHOLD = 3.5
+# Lower bound of the robust spread, so curves that are flat in a frame don't
+# turn rounding noise into outliers
+MIN_SPREAD = 0.5
+
+
+def _line_residuals(windows, w, t):
+    # Absolute residuals of the least squares line through the values where w,
+    # for every reading frame at once
+    y = np.where(w, windows, 0)
+    n, st, stt = w.sum(-1), (w * t).sum(-1), (w * t * t).sum(-1)
+    sy, sty = y.sum(-1), (y * t).sum(-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = (n * sty - st * sy) / (n * stt - st * st)
+        intercept = (sy - slope * st) / n
+    return np.abs(windows - intercept[..., None] - slope[..., None] * t)
+
+
+def _nanmedian(values):
+    # Reading frames without values have no spread, NaN compares as not flagged
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return np.nanmedian(values, axis=-1, keepdims=True)
+
+
+def _window_votes(gray, interval_size, step):
+    # Start of every reading frame, the last one ends on the last time point
+    n_frames = gray.shape[-1]
+    starts = np.arange(0, n_frames - interval_size + 1, step)
+    if starts[-1] != n_frames - interval_size:
+        starts = np.append(starts, n_frames - interval_size)
+
+    # Strided view of every reading frame, (S, P, W, L)
+    windows = sliding_window_view(gray, interval_size, axis=-1)[..., starts, :]
+    t = np.arange(interval_size) - (interval_size - 1) / 2
+
+    # Fit again without the flagged points, so a large outlier can't pull the
+    # line away from its neighbours
+    flagged = np.isnan(windows)
+    for _ in range(2):
+        residual = _line_residuals(windows, ~flagged, t)
+        spread = 1.4826 * _nanmedian(np.where(flagged, np.nan, residual))
+        flagged = residual > MAD_THRESHOLD * np.maximum(spread, MIN_SPREAD)
+
+    # Add the votes of every frame back onto the time axis, the frames starting
+    # at different points never overlap for the same offset
+    votes = np.zeros(gray.shape, dtype=np.int64)
+    for offset in range(interval_size):
+        votes[..., starts + offset] += flagged[..., offset]
+
+    positions = starts[:, None] + np.arange(interval_size)
+    coverage = np.bincount(positions.ravel(), minlength=n_frames)
+    return votes, coverage
+
+
+def _interpolate(time, gray, outliers):
+    # Linear interpolation in time between the nearest good values on both sides
+    good = ~outliers & ~np.isnan(gray)
+    index = np.arange(gray.shape[-1])
+    last = len(index) - 1
+    before = np.maximum.accumulate(np.where(good, index, -1), axis=-1)
+    after = np.where(good, index, len(index))[..., ::-1]
+    after = np.minimum.accumulate(after, axis=-1)[..., ::-1]
+
+    has_before, has_after = before >= 0, after <= last
+    before, after = np.clip(before, 0, last), np.clip(after, 0, last)
+    before_value = np.take_along_axis(gray, before, -1)
+    after_value = np.take_along_axis(gray, after, -1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fraction = (time - time[before]) / (time[after] - time[before])
+    between = before_value + fraction * (after_value - before_value)
+
+    cleaned = np.where(has_before & has_after, between, gray)
+    cleaned = np.where(has_before & ~has_after, before_value, cleaned)
+    cleaned = np.where(~has_before & has_after, after_value, cleaned)
+    return np.where(outliers, cleaned, gray)
+
+
+def clean_data(df, interval_size=20, votes=4, interval_jump=5, metrics=None):
+    """
+    Replace the outliers in the gray values of every point, found by voting over a
+    sliding reading frame of interval_size frames that moves interval_size /
+    interval_jump frames at a time. Time points covered by fewer than votes frames
+    (at the ends of the curves) need a vote from every frame covering them.
+    Returns a new results store with the cleaned gray and mean values.
+    """
+    store = as_store(df)
+    gray = store["gray"]
+    n_frames = gray.shape[-1]
+
+    if interval_size < 3 or n_frames < interval_size:
+        logger.warning(
+            f"Can't clean {n_frames} frames with an interval size of {interval_size}, skipping."
+        )
+        return store
+
+    step = max(1, interval_size // interval_jump)
+    frame_votes, coverage = _window_votes(gray, interval_size, step)
+    outliers = (frame_votes >= np.minimum(votes, coverage)) & ~np.isnan(gray)
+
+    cleaned = _interpolate(store["time"], gray, outliers)
+    n_points = np.maximum(store["n_points"], 1)[:, None]
+    change = np.where(outliers, cleaned - gray, 0).sum(axis=1) / n_points
+
+    n_outliers = int(outliers.sum())
+    logger.info(f"Replaced {n_outliers} outliers.")
+    count(metrics, "outliers", n_outliers)
+
+    return dict(store, gray=cleaned, mean=store["mean"] + change)
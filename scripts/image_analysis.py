@@ -1,13 +1,62 @@
 import os
 import cv2
 import numpy as np
-import csv
 import pandas as pd
 from concurrent import futures
+from collections import deque, OrderedDict
+from itertools import groupby
+from contextlib import nullcontext
 import logging
+from scripts.cache import analysis_key, frame_key, cache_get, cache_put
+from scripts.metrics import stage, add_time, count, record, clock, elapsed
 
 logger = logging.getLogger(__name__)
 
+# imread flags for the decode modes, the reduced modes let libjpeg decode at
+# 1/2, 1/4 or 1/8 of the resolution which is much cheaper than a full decode.
+# The _gray modes decode a single channel, libjpeg then skips the color
+# conversion of the whole picture. On 24MP pictures this halved the full decode
+# time. Fewer than 1 in 10000 pixels differ from converting the color frame with
+# cvtColor, by at most 2 gray levels, so an ROI mean can differ by at most
+# 2 / its number of pixels (0.02 for the default roi size); the ROI means of the
+# test pictures were identical
+DECODE_MODES = {
+    "full": (cv2.IMREAD_COLOR, 1),
+    "reduced2": (cv2.IMREAD_REDUCED_COLOR_2, 2),
+    "reduced4": (cv2.IMREAD_REDUCED_COLOR_4, 4),
+    "reduced8": (cv2.IMREAD_REDUCED_COLOR_8, 8),
+    "full_gray": (cv2.IMREAD_GRAYSCALE, 1),
+    "reduced2_gray": (cv2.IMREAD_REDUCED_GRAYSCALE_2, 2),
+    "reduced4_gray": (cv2.IMREAD_REDUCED_GRAYSCALE_4, 4),
+    "reduced8_gray": (cv2.IMREAD_REDUCED_GRAYSCALE_8, 8),
+}
+
+# Number of frame size and drift shift combinations whose ROI bounds and pixels
+# are kept in a plan
+PLAN_CACHE_SIZE = 4
+
+# Per ROI color features as (color space, channel). Every feature is the mean of
+# the channel over the ROI, with a _std suffix its standard deviation. Hue is in
+# OpenCV units (0-180) and wraps around at red, so its mean is only meaningful
+# for samples that stay away from red
+COLOR_FEATURES = {
+    "gray": ("gray", 0),
+    "blue": ("bgr", 0),
+    "green": ("bgr", 1),
+    "red": ("bgr", 2),
+    "hue": ("hsv", 0),
+    "saturation": ("hsv", 1),
+    "value": ("hsv", 2),
+    "lightness": ("lab", 0),
+    "lab_a": ("lab", 1),
+    "lab_b": ("lab", 2),
+}
+COLOR_CONVERSIONS = {
+    "gray": cv2.COLOR_BGR2GRAY,
+    "hsv": cv2.COLOR_BGR2HSV,
+    "lab": cv2.COLOR_BGR2LAB,
+}
+
 
 def pictures(folder_path):
     logger.info(f"Retrieving pictures from {folder_path}.")
@@ -54,119 +103,847 @@ def get_color_intensity(image, coordinates, roi_size=5):
         logger.error(f"Error: {e}", exc_info=True)
 
 
-def process_images(folder_path, coordinates, time_interval=5, roi_size=5):
+def read_frame(image_path, decode="full"):
+    """
+    Read a frame with the given decode mode, returns None if it can't be read.
+    """
+    flag, _ = DECODE_MODES[decode]
+    return cv2.imread(image_path, flag)
+
+
+def _untimed(filenames, timeline):
+    # Pictures written after the timeline was built have no time, they are left
+    # out until the next run
+    if timeline is None:
+        return set()
+    missing = {filename for filename in filenames if filename not in timeline}
+    if missing:
+        logger.warning(
+            f"{len(missing)} pictures are newer than the timeline, leaving them out: {', '.join(sorted(missing))}"
+        )
+    return missing
+
+
+def gray_decode(decode, features=None):
+    """
+    The single channel variant of a decode mode if only gray values are measured
+    (features has nothing but gray), otherwise decode itself.
+    """
+    if decode.endswith("_gray") or parse_features(features) != ["gray"]:
+        return decode
+    return f"{decode}_gray"
+
+
+def parse_features(features=None):
+    """
+    Check a list of color feature names (see COLOR_FEATURES) and return it with
+    gray first and without duplicates.
+    """
+    parsed = ["gray"]
+    for feature in features or []:
+        name = feature[:-4] if feature.endswith("_std") else feature
+        if name not in COLOR_FEATURES:
+            raise ValueError(
+                f"Unknown feature {feature}, use one of {', '.join(COLOR_FEATURES)} or add _std."
+            )
+        if feature not in parsed:
+            parsed.append(feature)
+    return parsed
+
+
+def _feature_spaces(features, shaped=False):
+    # Group the color features (all but the gray mean) by color space, so every
+    # space is converted once per frame. Every entry is
+    # (space, [(feature index, channel, std)]). The gray mean of shaped ROIs is
+    # also taken from the gathered pixels
+    spaces = {"gray": [(0, 0, False)]} if shaped else {}
+    for i, feature in enumerate(features[1:], start=1):
+        std = feature.endswith("_std")
+        space, channel = COLOR_FEATURES[feature[:-4] if std else feature]
+        spaces.setdefault(space, []).append((i, channel, std))
+    return list(spaces.items())
+
+
+def _roi_shapes(df, order, roi_size, base):
+    # (plan index, shape, parameters) of every point that isn't a square window,
+    # in full resolution pixels with x the image row and y the column
+    if "shape" not in df.columns:
+        return []
+
+    shapes = []
+    for j, row in enumerate(df.iloc[order].to_dict("records")):
+        shape = row["shape"]
+        shape = "square" if pd.isna(shape) else str(shape).strip().lower()
+        if shape == "square":
+            continue
+        elif shape == "circle":
+            radius = row.get("radius")
+            radius = roi_size if radius is None or pd.isna(radius) else radius
+            shapes.append((j, shape, (row["x"], row["y"], float(radius))))
+        elif shape == "polygon":
+            vertices = np.array(str(row["vertices"]).split(), dtype=np.float64)
+            if len(vertices) < 6 or len(vertices) % 2:
+                raise ValueError(
+                    f"A polygon of {row['name']} needs at least three x y pairs."
+                )
+            shapes.append((j, shape, vertices.reshape(-1, 2)))
+        elif shape == "mask":
+            label = row.get("label")
+            label = None if label is None or pd.isna(label) else int(label)
+            path = os.path.abspath(os.path.join(base, str(row["mask"])))
+            shapes.append((j, shape, (path, label)))
+        else:
+            raise ValueError(
+                f"Unknown ROI shape {shape} of {row['name']}, use square, circle, polygon or mask."
+            )
+    return shapes
+
+
+def build_roi_plan(coordinates, roi_size=5, decode="full", features=None):
+    """
+    Compile the coords csv into flat index arrays, grouped by sample, so every
+    frame can be evaluated without going back to the DataFrame.
+    The coordinates stay in full resolution, the plan is scaled to the decode mode.
+    features are extra color features measured next to the gray value.
+    An optional shape column gives points another ROI than the square window:
+    circle (radius column, roi_size if empty), polygon (vertices column with
+    "x y x y ..." in full resolution) or mask (mask column with the path of a
+    label image covering the whole picture, relative to the coords csv, and the
+    label column with the value of the region, any nonzero pixel if empty).
+    """
+    if isinstance(coordinates, str):
+        df = pd.read_csv(coordinates)
+        base = os.path.dirname(os.path.abspath(coordinates))
+    else:
+        df = coordinates
+        base = os.getcwd()
+
+    features = parse_features(features)
+    if decode.endswith("_gray") and features != ["gray"]:
+        raise ValueError(f"Color features need a color decode mode, not {decode}.")
+    samples = df["name"].unique().tolist()
+    codes = pd.Categorical(df["name"], categories=samples).codes
+    order = np.argsort(codes, kind="stable")
+    counts = np.bincount(codes, minlength=len(samples))
+    shapes = _roi_shapes(df, order, roi_size, base)
+    square = np.ones(len(df), dtype=bool)
+    square[[j for j, _, _ in shapes]] = False
+
+    # get_color_intensity is called with (y, x) and unpacks it as (x, y), so the
+    # csv "y" column indexes image columns and "x" indexes image rows
+    return {
+        "samples": samples,
+        "colors": [df[df["name"] == sample]["color"].iloc[0] for sample in samples],
+        "offsets": np.concatenate(([0], np.cumsum(counts))),
+        "cols": df["y"].to_numpy(dtype=np.int64)[order],
+        "rows": df["x"].to_numpy(dtype=np.int64)[order],
+        "roi_size": int(roi_size),
+        "scale": DECODE_MODES[decode][1],
+        "features": features,
+        "spaces": _feature_spaces(features, bool(shapes)),
+        "shapes": shapes,
+        "square": square,
+        "bounds": OrderedDict(),
+        "pixels": OrderedDict(),
+        "unshifted": {},
+    }
+
+
+def _cache_get(cache, key):
+    # Least recently used lookup in a plan cache, see _cache_put. The threads of
+    # the thread backend share the plan, so the cache is only changed with single
+    # OrderedDict operations and an entry may vanish between them
+    value = cache.get(key)
+    if value is not None:
+        try:
+            cache.move_to_end(key)
+        except KeyError:
+            pass
+    return value
+
+
+def _cache_put(cache, key, value):
+    # With a drift correction every shift is a new key, so only the most recently
+    # used PLAN_CACHE_SIZE entries are kept
+    cache[key] = value
+    while len(cache) > PLAN_CACHE_SIZE:
+        try:
+            cache.popitem(last=False)
+        except KeyError:
+            break
+
+
+def _plan_bounds(plan, shape, shift=(0, 0)):
+    # Clipped ROI bounds only depend on the frame size and the drift shift (in
+    # full resolution pixels), so compute them once
+    bounds = _cache_get(plan["bounds"], (shape, shift))
+    if bounds is not None:
+        return bounds
+
+    h, w = shape
+    r, f = plan["roi_size"], plan["scale"]
+    cols, rows = plan["cols"] + shift[0], plan["rows"] + shift[1]
+    valid = (cols >= 0) & (cols // f < w) & (rows >= 0) & (rows // f < h)
+    # Shaped ROIs are measured from their pixels, see _shape_pixels
+    valid &= plan["square"]
+
+    # Map the full resolution window onto the decoded frame, rounding outwards
+    x1, x2 = np.clip((cols - r) // f, 0, w), np.clip(-(-(cols + r) // f), 0, w)
+    y1, y2 = np.clip((rows - r) // f, 0, h), np.clip(-(-(rows + r) // f), 0, h)
+
+    # Bounding box of every valid ROI, only this part of the frame is converted
+    if valid.any():
+        box = (y1[valid].min(), y2[valid].max(), x1[valid].min(), x2[valid].max())
+    else:
+        box = (0, 0, 0, 0)
+
+    # ROIs outside the frame get an empty window inside the box, their mean is -1
+    bounds = (
+        np.where(valid, x1 - box[2], 0),
+        np.where(valid, x2 - box[2], 0),
+        np.where(valid, y1 - box[0], 0),
+        np.where(valid, y2 - box[0], 0),
+        (x2 - x1) * (y2 - y1),
+        valid,
+        box,
+    )
+    _cache_put(plan["bounds"], (shape, shift), bounds)
+    return bounds
+
+
+def roi_means(image, plan, shift=(0, 0)):
+    """
+    Mean grayscale intensity of every ROI in the plan, in plan order.
+    Gives the same numbers as calling get_color_intensity per coordinate for the
+    square ROIs, shaped ROIs are averaged over all their pixels.
+    shift moves all ROIs by (dx, dy) full resolution pixels, see registration.py.
+    If the plan has color features their values follow the gray means, one block
+    of len(plan["cols"]) values per feature.
+    """
+    x1, x2, y1, y2, area, valid, box = _plan_bounds(plan, image.shape[:2], shift)
+    means = np.full((len(plan["features"]), len(valid)), -1.0)
+    if plan["spaces"]:
+        _color_features(image, plan, means, shift)
+    if not valid.any():
+        return means.ravel()
+
+    crop = image[box[0] : box[1], box[2] : box[3]]
+    gray = crop if crop.ndim == 2 else cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+
+    # Summed-area table, every ROI sum is then four lookups
+    integral = cv2.integral(gray, sdepth=cv2.CV_64F)
+    sums = integral[y2, x2] - integral[y1, x2] - integral[y2, x1] + integral[y1, x1]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        means[0, valid] = sums[valid] / area[valid]
+    return means.ravel()
+
+
+def _roi_pixels(plan, shape, shift):
+    # Flat index into the frame of every pixel of every valid ROI, the ROI it
+    # belongs to and the pixel count of every ROI. The pixels without drift shift
+    # are kept for every frame size, shifted ones like the bounds
+    if shift == (0, 0):
+        pixels = plan["unshifted"].get(shape)
+    else:
+        pixels = _cache_get(plan["pixels"], (shape, shift))
+    if pixels is not None:
+        return pixels
+
+    x1, x2, y1, y2, area, valid, box = _plan_bounds(plan, shape, shift)
+    area = np.where(valid, area, 0)
+    roi = np.repeat(np.arange(len(valid)), area)
+    offset = np.arange(len(roi)) - (np.cumsum(area) - area)[roi]
+    width = np.maximum(x2 - x1, 1)[roi]
+    rows = box[0] + y1[roi] + offset // width
+    cols = box[2] + x1[roi] + offset % width
+
+    index = rows * shape[1] + cols
+    if plan["shapes"]:
+        shape_index, shape_roi = _shape_pixels(plan, shape, shift)
+        index = np.concatenate((index, shape_index))
+        roi = np.concatenate((roi, shape_roi))
+
+    # int32 halves the memory and pickling of whole colony ROIs
+    pixels = (
+        index.astype(np.int32),
+        roi.astype(np.int32),
+        np.bincount(roi, minlength=len(valid)),
+    )
+    if shift == (0, 0):
+        plan["unshifted"][shape] = pixels
+    else:
+        _cache_put(plan["pixels"], (shape, shift), pixels)
+    return pixels
+
+
+def _mask_pixels(path, shape):
+    # Flat index of the nonzero pixels of a label image resized to the frame, and
+    # their labels, sorted by label
+    mask = cv2.imread(path, cv2.IMREAD_ANYDEPTH | cv2.IMREAD_GRAYSCALE)
+    if mask is None:
+        raise ValueError(f"Could not read the ROI mask {path}.")
+    mask = cv2.resize(mask, shape[::-1], interpolation=cv2.INTER_NEAREST).ravel()
+    index = np.flatnonzero(mask)
+    labels = mask[index]
+    order = np.argsort(labels, kind="stable")
+    return index[order], labels[order]
+
+
+def _rasterize(shapes, shape, scale):
+    # (rows, cols) in the decoded frame of every shaped ROI. A pixel belongs to a
+    # circle or polygon if its center is inside, with the centers at
+    # (i + 0.5) * scale in full resolution like the square windows
+    f = scale
+    masks = {}
+    rasters = []
+    for _, kind, param in shapes:
+        if kind == "circle":
+            row, col, radius = param
+            i = np.arange(np.floor((row - radius) / f), np.ceil((row + radius) / f))
+            j = np.arange(np.floor((col - radius) / f), np.ceil((col + radius) / f))
+            inside = ((i[:, None] + 0.5) * f - row) ** 2 + (
+                (j[None, :] + 0.5) * f - col
+            ) ** 2 <= radius**2
+            r, c = np.nonzero(inside)
+            rasters.append((i[r].astype(np.int64), j[c].astype(np.int64)))
+        elif kind == "polygon":
+            # Even-odd rule on the pixel centers, one edge at a time
+            top, left = np.floor(param.min(axis=0) / f).astype(np.int64)
+            bottom, right = np.ceil(param.max(axis=0) / f).astype(np.int64)
+            i = (np.arange(top, bottom) + 0.5) * f
+            j = (np.arange(left, right) + 0.5) * f
+            inside = np.zeros((len(i), len(j)), dtype=bool)
+            for (r1, c1), (r2, c2) in zip(param, np.roll(param, -1, axis=0)):
+                crossing = np.flatnonzero((r1 > i) != (r2 > i))
+                c = c1 + (i[crossing] - r1) * (c2 - c1) / (r2 - r1)
+                inside[crossing] ^= j[None, :] < c[:, None]
+            r, c = np.nonzero(inside)
+            rasters.append((r + top, c + left))
+        else:
+            path, label = param
+            if path not in masks:
+                masks[path] = _mask_pixels(path, shape)
+            index, labels = masks[path]
+            if label is not None:
+                index = index[
+                    np.searchsorted(labels, label) : np.searchsorted(
+                        labels, label, side="right"
+                    )
+                ]
+            rasters.append((index // shape[1], index % shape[1]))
+    return rasters
+
+
+def prepare_plan(plan, shape):
+    """
+    List the ROI pixels of the plan for frames of the given (height, width) ahead
+    of time, so a plan sent to a process pool carries them instead of every
+    worker drawing the shapes and reading the masks again.
+    """
+    if plan["shapes"]:
+        _roi_pixels(plan, shape, (0, 0))
+    return plan
+
+
+def _shape_pixels(plan, shape, shift):
+    # Flat index of the pixels of the shaped ROIs inside the frame and their ROI.
+    # The shapes are rasterized once per frame size and shifted pixels are moved
+    # from those, with the drift shift rounded to whole decoded pixels. A circle
+    # or polygon cut off by the frame border is rasterized again, as the shift can
+    # move its cut off pixels into the frame
+    h, w = shape
+    rasterize = shift == (0, 0)
+    if not rasterize:
+        index, roi, n = _roi_pixels(plan, shape, (0, 0))
+        first = n[plan["square"]].sum()
+        rows, cols = np.divmod(index[first:].astype(np.int64), w)
+        roi = roi[first:]
+        drawn = np.zeros(len(n), dtype=bool)
+        drawn[[j for j, kind, _ in plan["shapes"] if kind != "mask"]] = True
+        border = (rows == 0) | (rows == h - 1) | (cols == 0) | (cols == w - 1)
+        rasterize = (border & drawn[roi]).any()
+    if rasterize:
+        rasters = _rasterize(plan["shapes"], shape, plan["scale"])
+        rows = np.concatenate([r for r, _ in rasters])
+        cols = np.concatenate([c for _, c in rasters])
+        roi = np.repeat([j for j, _, _ in plan["shapes"]], [len(r) for r, _ in rasters])
+
+    f = plan["scale"]
+    rows = rows + int(round(shift[1] / f))
+    cols = cols + int(round(shift[0] / f))
+    inside = (rows >= 0) & (rows < h) & (cols >= 0) & (cols < w)
+    return rows[inside] * w + cols[inside], roi[inside]
+
+
+def _color_features(image, plan, means, shift):
+    # Only the ROI pixels are gathered and converted, once per color space, and
+    # summed per ROI with bincount. The gray mean of the square ROIs comes from
+    # the integral image, only the one of the shaped ROIs is set here
+    index, roi, n = _roi_pixels(plan, image.shape[:2], shift)
+    if not len(index):
+        return
+    n_rois = means.shape[1]
+    channels = 1 if image.ndim == 2 else image.shape[2]
+    valid = n > 0
+    shaped = valid & ~plan["square"]
+
+    # Large ROIs cover much of the frame, then converting the frame down to the
+    # last ROI row at once is cheaper than gathering the color pixels first
+    h, w = image.shape[:2]
+    dense = len(index) * 16 > h * w
+    if dense:
+        frame = image[: index.max() // w + 1]
+    else:
+        pixels = image.reshape(-1, channels)[index]
+
+    for space, items in plan["spaces"]:
+        if channels == 1 and space != "gray":
+            raise ValueError(f"The {space} features need a color frame.")
+        if not dense:
+            if space == "bgr" or channels == 1:
+                values = pixels
+            else:
+                values = cv2.cvtColor(pixels[:, None, :], COLOR_CONVERSIONS[space])
+                values = values.reshape(len(index), -1)
+        elif space == "bgr" or channels == 1:
+            values = frame.reshape(-1, channels)
+        else:
+            values = cv2.cvtColor(frame, COLOR_CONVERSIONS[space])
+            values = values.reshape(len(values) * w, -1)
+
+        for i, channel, std in items:
+            v = values[index, channel] if dense else values[:, channel]
+            v = v.astype(np.float64)
+            mean = np.bincount(roi, v, n_rois)[valid] / n[valid]
+            if std:
+                square = np.bincount(roi, v * v, n_rois)[valid] / n[valid]
+                mean = np.sqrt(np.maximum(square - mean * mean, 0))
+            if i == 0:
+                means[0, shaped] = mean[shaped[valid]]
+            else:
+                means[i, valid] = mean
+
+
+def frame_rows(time, means, plan, skip_missing=False):
+    """
+    Group the per point means of one frame into one result row per sample. With
+    color features every row has the values of every feature as a sixth element.
+    """
+    rows = []
+    offsets = plan["offsets"]
+    values = means.reshape(len(plan["features"]), -1)
+    for i, sample in enumerate(plan["samples"]):
+        grays = values[0, offsets[i] : offsets[i + 1]]
+        mean_gray = np.mean(grays)
+
+        if skip_missing and mean_gray == -1:
+            continue
+        row = (time, sample, plan["colors"][i], mean_gray, grays.tolist())
+        if len(values) > 1:
+            row += (values[1:, offsets[i] : offsets[i + 1]].tolist(),)
+        rows.append(row)
+    return rows
+
+
+def process_images(
+    folder_path,
+    coordinates,
+    time_interval=5,
+    roi_size=5,
+    decode="full",
+    cache=None,
+    metrics=None,
+    stack=None,
+    skip=None,
+    timeline=None,
+    registration=None,
+    features=None,
+    writer=None,
+):
     """
     Process all images in the given folder and calculate color intensity and vibrancy
     at the specified coordinates.
+    If a cache connection is given, frames analysed before are not decoded again.
+    If stack is the directory of a frame stack (see scripts/stack.py), the ROIs
+    are read from its memory mapped frames instead and decode is taken from it.
+    Pictures in skip (filenames, e.g. from the quality prefilter) are left out.
+    With a timeline (filename to minutes, see scripts/timeline.py) the pictures get
+    their own time, otherwise every readable picture is time_interval later.
+    With a registration (see scripts/registration.py) the ROIs follow the drift of
+    every picture, the offsets of new pictures are added to it.
+    features are color features measured next to the gray value (see
+    COLOR_FEATURES), the rows then have their values as a sixth element.
+    With a writer (see open_writer in scripts/results.py) the rows of every frame
+    are written to it as soon as the frame is analysed instead of returned.
     """
     logger.info(
-        f"Processing images in sequential mode with time_interval={time_interval} and roi_size={roi_size}."
+        f"Processing images in sequential mode with time_interval={time_interval}, roi_size={roi_size} and decode={decode}."
     )
     try:
-        if type(coordinates) == str:
-            df = pd.read_csv(coordinates)
-        else:
-            df = coordinates
+        if stack is not None:
+            # Imported here, the stack module builds on this one
+            from scripts.stack import process_stack
+
+            results = process_stack(
+                stack, coordinates, time_interval, roi_size, metrics, skip, timeline
+            )
+            if writer is None:
+                return results
+            from scripts.results import write_frame
+
+            for _, rows in groupby(results, key=lambda row: row[0]):
+                write_frame(writer, list(rows))
+            return []
+
+        plan = build_roi_plan(coordinates, roi_size, decode, features)
+        if cache is not None:
+            analysis = analysis_key(
+                coordinates,
+                roi_size,
+                decode,
+                registration and registration["key"],
+                plan["features"],
+            )
+        if writer is not None:
+            # Imported here, the results module builds on this one
+            from scripts.results import write_frame
         results = []
 
-        filenames = pictures(folder_path)
+        with stage(metrics, "listing"):
+            filenames = [f for f in pictures(folder_path) if f[1] not in (skip or ())]
+            late = _untimed([f[1] for f in filenames], timeline)
+            filenames = [f for f in filenames if f[1] not in late]
+
         time = -time_interval
         for filename in filenames:
             image_path = os.path.join(folder_path, filename[1])
-            image = cv2.imread(image_path)
 
-            if image is not None:
-                time += time_interval
+            means = None
+            if cache is not None:
+                key = frame_key(image_path, analysis)
+                means = cache_get(cache, key)
+
+            if means is None:
+                _, _, means, decode_s, roi_s, offset = _analyse_frames(
+                    folder_path, [filename], plan, decode, registration
+                )[0]
+                _frame_metrics(metrics, decode_s, roi_s)
+                if offset is not None:
+                    registration["offsets"][filename[1]] = offset
+                if means is None:
+                    logger.warning(f"Could not read {image_path}, skipping.")
+                    count(metrics, "frames_unreadable")
+                    continue
 
-                for sample in df["name"].unique().tolist():
-                    grays = []
-                    sample_coords = df[df["name"] == sample][["y", "x"]]
-                    for _, row in sample_coords.iterrows():
-                        coord = (row["y"], row["x"])
-                        gray = get_color_intensity(image, coord, roi_size)
-                        grays.append(gray)
-
-                    results.append(
-                        (
-                            time,
-                            sample,
-                            df[df["name"] == sample]["color"].tolist()[0],
-                            np.mean(grays),
-                            grays,
-                        )
-                    )
+                if cache is not None:
+                    cache_put(cache, key, means)
+            else:
+                count(metrics, "frames_cached")
+
+            if timeline is not None:
+                time = timeline[filename[1]]
+            else:
+                time += time_interval
+            if writer is not None:
+                write_frame(writer, frame_rows(time, means, plan))
+            else:
+                results.extend(frame_rows(time, means, plan))
         return results
     except Exception as e:
         logger.error(f"Error: {e}", exc_info=True)
 
 
-def process_images_parallel(folder_path, coordinates, time_interval=5, roi_size=5):
-    logger.info(
-        f"Processing images in parallel mode with time_interval={time_interval} and roi_size={roi_size}."
-    )
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _analyse_frames(folder_path, chunk, plan, decode, registration=None):
+    # Module level so it can be pickled to a process pool. The decode and ROI
+    # extraction (wall, cpu) times are returned with the means so they can be
+    # recorded. With
+    # a registration the drift offset is estimated from the decoded frame, unless
+    # it is known already, and returned as well
+    if registration is not None:
+        # Imported here, the registration module builds on this one
+        from scripts.registration import frame_offset, plan_shift
+
+    local_results = []
+    for index, filename in chunk:
+        start = clock()
+        image = read_frame(os.path.join(folder_path, filename), decode)
+        decode_s, start = elapsed(start), clock()
+
+        means, offset = None, None
+        if image is not None:
+            shift = (0, 0)
+            if registration is not None:
+                offset = registration["offsets"].get(filename)
+                if offset is None:
+                    offset = frame_offset(image, registration["image"], plan["scale"])
+                shift = plan_shift(offset)
+            means = roi_means(image, plan, shift)
+        local_results.append((index, filename, means, decode_s, elapsed(start), offset))
+    return local_results
+
+
+def _frame_metrics(metrics, decode_s, roi_s):
+    add_time(metrics, "decode", *decode_s)
+    add_time(metrics, "roi_extraction", *roi_s)
+    record(metrics, "decode_latency", decode_s[0])
+    count(metrics, "frames_decoded")
+
+
+def _executor(backend, workers):
+    if backend == "thread":
+        return futures.ThreadPoolExecutor(max_workers=workers)
+    elif backend == "process":
+        return futures.ProcessPoolExecutor(max_workers=workers)
+    raise ValueError(f"Unknown backend {backend}, use thread or process.")
+
+
+def _interleave(runs):
+    # Round robin over the chunks of every run, so all runs progress together
+    runs = [iter(chunks) for chunks in runs]
+    while runs:
+        for chunks in list(runs):
+            chunk = next(chunks, None)
+            if chunk is None:
+                runs.remove(chunks)
+            else:
+                yield chunk
+
+
+def process_runs_parallel(
+    runs,
+    backend="thread",
+    workers=None,
+    chunksize=4,
+    max_in_flight=None,
+    cache=None,
+    metrics=None,
+    executor=None,
+):
+    """
+    Process the images of several runs on one pool. runs is a list of dicts with
+    folder_path, coordinates and optionally time_interval, roi_size, decode, skip
+    (a set of filenames to leave out), timeline (filename to minutes),
+    registration (see scripts/registration.py, new offsets are added to it),
+    features (color features, see COLOR_FEATURES) and writer (see open_writer in
+    scripts/results.py, the rows of the run are written to it instead of returned).
+    The frames of all runs are scheduled together and at most max_in_flight chunks
+    are queued at once. Returns the results of every run in the same order, None
+    for runs that could not be set up. An existing executor can be passed to share
+    its workers, otherwise one is created for the given backend.
+    """
     try:
-        if isinstance(coordinates, str):
-            df = pd.read_csv(coordinates)
-        else:
-            df = coordinates
-
-        filenames = pictures(folder_path)
-
-        def analysis(filename):
-            # Create a local list to store results for this image
-            local_results = []
+        workers = workers or os.cpu_count() or 1
+        max_in_flight = max_in_flight or 2 * workers
 
-            image_path = os.path.join(folder_path, filename[1])
-            image = cv2.imread(image_path)
-            time = filename[0] * time_interval
+        jobs = []
+        results = []
+        for n, run in enumerate(runs):
+            folder_path = run["folder_path"]
+            roi_size = run.get("roi_size", 5)
+            decode = run.get("decode", "full")
+            try:
+                plan = build_roi_plan(
+                    run["coordinates"], roi_size, decode, run.get("features")
+                )
+                with stage(metrics, "listing"):
+                    filenames = [
+                        f
+                        for f in pictures(folder_path)
+                        if f[1] not in run.get("skip", ())
+                    ]
+                    late = _untimed([f[1] for f in filenames], run.get("timeline"))
+                    filenames = [f for f in filenames if f[1] not in late]
+                # The shapes are rasterized here once, not in every chunk
+                if plan["shapes"]:
+                    for _, filename in filenames:
+                        image = read_frame(os.path.join(folder_path, filename), decode)
+                        if image is not None:
+                            prepare_plan(plan, image.shape[:2])
+                            break
+            except Exception as e:
+                logger.error(f"Error in run {folder_path}: {e}", exc_info=True)
+                results.append(None)
+                continue
+
+            registration = run.get("registration")
+            analysis = None
+            if cache is not None:
+                analysis = analysis_key(
+                    run["coordinates"],
+                    roi_size,
+                    decode,
+                    registration and registration["key"],
+                    plan["features"],
+                )
+            jobs.append(
+                {
+                    "run": n,
+                    "folder_path": folder_path,
+                    "plan": plan,
+                    "decode": decode,
+                    "analysis": analysis,
+                    "time_interval": run.get("time_interval", 5),
+                    "timeline": run.get("timeline"),
+                    "registration": registration,
+                    "writer": run.get("writer"),
+                    "filenames": filenames,
+                }
+            )
+            results.append([])
+
+        pending = deque()
+        keys = {}
+        if any(job["writer"] is not None for job in jobs):
+            # Imported here, the results module builds on this one
+            from scripts.results import write_frame
+
+        def collect(job, cached, future):
+            n = job["run"]
+            frames = cached + (future.result() if future is not None else [])
+            for index, filename, means, decode_s, roi_s, offset in sorted(
+                frames, key=lambda frame: frame[0]
+            ):
+                if decode_s is None:
+                    count(metrics, "frames_cached")
+                else:
+                    _frame_metrics(metrics, decode_s, roi_s)
+                if offset is not None:
+                    job["registration"]["offsets"][filename] = offset
 
-            for sample in df["name"].unique():
-                sample_coords = df[df["name"] == sample][["y", "x"]]
-                grays = []
-                for _, row in sample_coords.iterrows():
-                    coord = (row["y"], row["x"])
-                    gray = get_color_intensity(image, coord, roi_size)
-                    grays.append(gray)
+                if means is None:
+                    logger.warning(f"Could not read {filename}, skipping.")
+                    count(metrics, "frames_unreadable")
+                    continue
 
-                color = df[df["name"] == sample]["color"].iloc[0]
+                if (n, index) in keys:
+                    cache_put(cache, keys.pop((n, index)), means)
 
-                if np.mean(grays) == -1:
-                    continue
+                if job["timeline"] is not None:
+                    time = job["timeline"][filename]
                 else:
-                    local_results.append((time, sample, color, np.mean(grays), grays))
-
-            return local_results
+                    time = index * job["time_interval"]
+                rows = frame_rows(time, means, job["plan"], skip_missing=True)
+                if job["writer"] is not None:
+                    write_frame(job["writer"], rows)
+                else:
+                    results[n].extend(rows)
+
+        chunks = _interleave(
+            [(job, chunk) for chunk in _chunks(job["filenames"], chunksize)]
+            for job in jobs
+        )
+        if executor is None:
+            pool = _executor(backend, workers)
+        else:
+            pool = nullcontext(executor)
+
+        with pool as ex:
+            for job, chunk in chunks:
+                n, folder_path = job["run"], job["folder_path"]
+                cached, todo = [], []
+                for index, filename in chunk:
+                    means = None
+                    if cache is not None:
+                        key = frame_key(
+                            os.path.join(folder_path, filename), job["analysis"]
+                        )
+                        means = cache_get(cache, key)
+
+                    if means is not None:
+                        cached.append((index, filename, means, None, None, None))
+                    else:
+                        if cache is not None:
+                            keys[(n, index)] = key
+                        todo.append((index, filename))
+
+                # Only the reference and the known offsets of the chunk are sent
+                registration = job["registration"]
+                if registration is not None:
+                    known = registration["offsets"]
+                    registration = {
+                        "image": registration["image"],
+                        "offsets": {f: known[f] for _, f in todo if f in known},
+                    }
+
+                future = None
+                if todo:
+                    future = ex.submit(
+                        _analyse_frames,
+                        folder_path,
+                        todo,
+                        job["plan"],
+                        job["decode"],
+                        registration,
+                    )
+                pending.append((job, cached, future))
 
-        # Execute analysis in parallel
-        with futures.ThreadPoolExecutor() as ex:
-            partial_results = list(ex.map(analysis, filenames))
+                # Collect in submission order to keep the results sorted by frame
+                if len(pending) >= max_in_flight:
+                    collect(*pending.popleft())
 
-        # Flatten the list of lists into a single results list
-        results = [item for sublist in partial_results for item in sublist]
+            while pending:
+                collect(*pending.popleft())
 
         return results
     except Exception as e:
         logger.error(f"Error: {e}", exc_info=True)
 
 
-def csv_writer(results, path):
-    logger.info(f"Writing image analysis results to results.csv at {path}.")
-
-    try:
-        headers = ["Time", "Name", "Color", "Mean_gray", "Gray"]
-        output_file = os.path.join(path, "results.csv")
-
-        with open(output_file, mode="w", newline="") as csvfile:
-            writer = csv.writer(csvfile)
-            if csvfile.tell() == 0:
-                writer.writerow(headers)
-            for result in results:
-                writer.writerow(result)
-
-        df = pd.read_csv(output_file)
-        df_sorted = df.sort_values(by="Time")
-
-        df_sorted.to_csv(output_file, index=False)
-        return df_sorted
-    except Exception as e:
-        logger.error(f"Error: {e}", exc_info=True)
+def process_images_parallel(
+    folder_path,
+    coordinates,
+    time_interval=5,
+    roi_size=5,
+    backend="thread",
+    workers=None,
+    chunksize=4,
+    max_in_flight=None,
+    decode="full",
+    cache=None,
+    metrics=None,
+    skip=None,
+    timeline=None,
+    registration=None,
+    features=None,
+    writer=None,
+):
+    """
+    Process the images with a thread or process pool. Frames are handed out in
+    chunks and at most max_in_flight chunks are queued at once, so memory use does
+    not grow with the length of the timelapse.
+    If a cache connection is given, only new or changed frames are sent to the pool.
+    With a writer the rows are written to it as the frames complete, see
+    process_images.
+    """
+    logger.info(
+        f"Processing images in parallel mode with time_interval={time_interval}, roi_size={roi_size}, decode={decode}, backend={backend} and workers={workers}."
+    )
+    run = {
+        "folder_path": folder_path,
+        "coordinates": coordinates,
+        "time_interval": time_interval,
+        "roi_size": roi_size,
+        "decode": decode,
+        "skip": skip or set(),
+        "timeline": timeline,
+        "registration": registration,
+        "features": features,
+        "writer": writer,
+    }
+    results = process_runs_parallel(
+        [run], backend, workers, chunksize, max_in_flight, cache, metrics
+    )
+    if results is not None:
+        return results[0]
@@ -0,0 +1,137 @@
+import json
+import time
+from contextlib import contextmanager
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Run metrics are a plain dict so they can be passed to any stage (or None to
+# skip the bookkeeping) and written to run_metrics.json as is:
+#   stages      wall and cpu seconds of every timed stage
+#   counters    e.g. frames analysed, cached or unreadable
+#   samples     per frame values like the decode latency, summarised on writing
+
+
+def new_metrics():
+    return {"stages": {}, "counters": {}, "samples": {}}
+
+
+@contextmanager
+def stage(metrics, name):
+    """
+    Time the wall and cpu time of the code in the with block as stage name.
+    """
+    if metrics is None:
+        yield
+        return
+
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        timer = metrics["stages"].setdefault(name, {"wall": 0.0, "cpu": 0.0})
+        timer["wall"] += time.perf_counter() - wall
+        timer["cpu"] += time.process_time() - cpu
+        logger.info(f"Stage {name} took {timer['wall']:.3f} s.")
+
+
+def clock():
+    # Wall and cpu time of the calling thread, for stages that run in workers
+    return time.perf_counter(), time.thread_time()
+
+
+def elapsed(start):
+    # (wall, cpu) seconds since start, a value of clock()
+    return time.perf_counter() - start[0], time.thread_time() - start[1]
+
+
+def add_time(metrics, name, seconds, cpu=None):
+    # For stages that run in workers, where only the summed time is known. The
+    # cpu time is left out if the worker didn't measure it
+    if metrics is not None:
+        timer = metrics["stages"].setdefault(name, {"wall": 0.0})
+        timer["wall"] += seconds
+        if cpu is not None:
+            timer["cpu"] = timer.get("cpu", 0.0) + cpu
+
+
+def count(metrics, name, n=1):
+    if metrics is not None:
+        metrics["counters"][name] = metrics["counters"].get(name, 0) + int(n)
+
+
+def record(metrics, name, value):
+    if metrics is not None:
+        metrics["samples"].setdefault(name, []).append(value)
+
+
+def _histogram(values, bins=20):
+    # numpy is imported here, the CLI imports this module before parsing arguments
+    import numpy as np
+
+    values = np.asarray(values, dtype=np.float64)
+    counts, edges = np.histogram(values, bins=bins)
+    return {
+        "n": len(values),
+        "mean": float(values.mean()),
+        "p50": float(np.percentile(values, 50)),
+        "p90": float(np.percentile(values, 90)),
+        "p99": float(np.percentile(values, 99)),
+        "max": float(values.max()),
+        "counts": counts.tolist(),
+        "edges": edges.tolist(),
+    }
+
+
+def write_metrics(metrics, path):
+    logger.info(f"Writing run metrics to {path}.")
+    report = {key: value for key, value in metrics.items() if key != "samples"}
+    report["histograms"] = {
+        name: _histogram(values)
+        for name, values in metrics["samples"].items()
+        if len(values)
+    }
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+@contextmanager
+def profiled(profiler, output_path):
+    """
+    Profile the with block with cProfile or pyinstrument (if installed) and save
+    the report in output_path. profiler None does nothing.
+    """
+    if profiler is None:
+        yield
+        return
+
+    if profiler == "pyinstrument":
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            logger.warning("pyinstrument is not installed, using cProfile instead.")
+            profiler = "cprofile"
+
+    if profiler == "pyinstrument":
+        prof = Profiler()
+        prof.start()
+        try:
+            yield
+        finally:
+            prof.stop()
+            with open(f"{output_path}/profile.html", "w") as f:
+                f.write(prof.output_html())
+        return
+
+    import cProfile
+    import pstats
+
+    prof = cProfile.Profile()
+    prof.enable()
+    try:
+        yield
+    finally:
+        prof.disable()
+        prof.dump_stats(f"{output_path}/profile.prof")
+        with open(f"{output_path}/profile.txt", "w") as f:
+            pstats.Stats(prof, stream=f).sort_stats("cumulative").print_stats(50)
@@ -1,25 +1,41 @@
-from matplotlib import pyplot as plt
 import numpy as np
-import pandas as pd
-import ast
 import os
 from typing import *
 import logging
+from concurrent import futures
+from functools import partial
+from contextlib import nullcontext
 from scipy.signal import savgol_filter
-from scripts.stat_test import bootstrap_mean
-import ruptures as rpt
+from scripts.stat_test import bootstrap_mean, bootstrap_means
+from scripts.results import as_store, sample_curves
+from scripts.metrics import stage, count
+from scripts.segmentation import binseg
 
 logger = logging.getLogger(__name__)
 
-# Finds the point where the maturation slows to the point where we assume that its done
+# matplotlib and ruptures are imported where they are used, so calculating the
+# halftimes without plots or with the fast backend doesn't load them
 
+# Finds the point where the maturation slows to the point where we assume that its done.
+# Both backends fit a line y = a + b * t to every segment: ruptures' "linear" model
+# gets the signal as [y, 1, t], the fast backend is the built-in binary
+# segmentation of scripts/segmentation.py with the same cost
 
-def find_plateau(y):
+
+def find_plateau(y, backend="ruptures", jump=5):
     try:
-        y_2d = y.reshape(-1, 1)
-        algo = rpt.Binseg(model="linear").fit(y_2d)
+        if backend == "fast":
+            result = binseg(y, n_bkps=2, jump=jump)
+        else:
+            import ruptures as rpt
 
-        result = algo.predict(n_bkps=2)
+            # Given y alone the linear model has no covariates and every split
+            # has the same cost, so the breakpoints were decided by noise
+            t = np.arange(len(y), dtype=np.float64)
+            signal = np.column_stack([y, np.ones(len(y)), t])
+            algo = rpt.Binseg(model="linear", jump=jump).fit(signal)
+
+            result = algo.predict(n_bkps=2)
 
         break_index = result[0]
 
@@ -29,7 +45,7 @@ def find_plateau(y):
         logger.error("Error: ", e)
 
 
-def halftime(x, y):
+def halftime(x, y, backend="ruptures"):
     """
     Calculate the halftime (the x-value where y reaches half of its total change).
     """
@@ -41,7 +57,7 @@ def halftime(x, y):
 
         y_smooth = savgol_filter(y, window_length=11, polyorder=2)
 
-        final_val = find_plateau(y_smooth)
+        final_val = find_plateau(y_smooth, backend)
         if final_val is not False:
 
             total_change = y[0] - final_val
@@ -59,21 +75,136 @@ def halftime(x, y):
         logger.error(f"Error: ", e)
 
 
+def find_plateaus(y_smooth, workers=None, backend="ruptures", executor=None, jump=5):
+    """
+    find_plateau for every row of y_smooth, NaN where it fails. With workers > 1
+    the rows are spread over a process pool, or over executor if one is given.
+    jump is the grid of candidate breakpoints, as in ruptures.
+    """
+    plateau = partial(find_plateau, backend=backend, jump=jump)
+    if executor is not None and len(y_smooth) > 1:
+        chunksize = max(1, len(y_smooth) // ((workers or os.cpu_count() or 1) * 4))
+        finals = list(executor.map(plateau, y_smooth, chunksize=chunksize))
+    elif workers is not None and workers > 1 and len(y_smooth) > 1:
+        chunksize = max(1, len(y_smooth) // (workers * 4))
+        with futures.ProcessPoolExecutor(max_workers=workers) as ex:
+            finals = list(ex.map(plateau, y_smooth, chunksize=chunksize))
+    else:
+        finals = [plateau(y) for y in y_smooth]
+
+    return np.array([np.nan if f is None else f for f in finals], dtype=np.float64)
+
+
+def _smooth(x, y, window_length=11, polyorder=2):
+    # Same length handling as halftime, curves with missing values are NaN
+    n = min(len(x), y.shape[1])
+    x, y = np.asarray(x, dtype=np.float64)[:n], y[:, :n]
+
+    y_smooth = np.full(y.shape, np.nan)
+    complete = ~np.isnan(y).any(axis=1)
+    if n >= window_length and complete.any():
+        y_smooth[complete] = savgol_filter(
+            y[complete], window_length=window_length, polyorder=polyorder, axis=1
+        )
+    return x, y, y_smooth
+
+
+def _halftimes(x, y, finals):
+    # Vectorized version of the halftime lookup in halftime
+    failed = np.isnan(finals)
+    if y.size == 0:
+        return np.full(len(y), np.nan)
+
+    halftime_y = finals + (y[:, 0] - finals) / 2.0
+    distance = np.abs(y - halftime_y[:, None])
+    distance[failed] = 0
+    halftime_index = distance.argmin(axis=1)
+    return np.where(failed, np.nan, x[halftime_index] / 60)
+
+
+def batch_halftimes(
+    x, y, window_length=11, polyorder=2, workers=None, backend="ruptures"
+):
+    """
+    Halftimes in hours of every curve (row) of y sampled at x, NaN where
+    the halftime can't be calculated. Same method and halftimes as halftime, but
+    the smoothing of all rows is one savgol_filter call.
+    """
+    y = np.atleast_2d(np.asarray(y, dtype=np.float64))
+    x, y, y_smooth = _smooth(x, y, window_length, polyorder)
+    valid = ~np.isnan(y_smooth).any(axis=1)
+
+    finals = np.full(len(y), np.nan)
+    finals[valid] = find_plateaus(y_smooth[valid], workers, backend)
+    return _halftimes(x, y, finals)
+
+
+def store_halftimes(
+    store,
+    window_length=11,
+    polyorder=2,
+    workers=None,
+    backend="ruptures",
+    executor=None,
+    jump=5,
+):
+    """
+    Halftimes of every point of every sample, as a dict of arrays per sample.
+    The plateaus of all samples are found in a single pass.
+    """
+    curves = [sample_curves(store, name) for name in store["name"]]
+    smoothed = [_smooth(x, y, window_length, polyorder) for x, y in curves]
+
+    y_smooth = (
+        np.concatenate([s[2] for s in smoothed]) if smoothed else np.empty((0, 0))
+    )
+    valid = ~np.isnan(y_smooth).any(axis=1)
+    finals = np.full(len(y_smooth), np.nan)
+    finals[valid] = find_plateaus(y_smooth[valid], workers, backend, executor, jump)
+
+    halftimes = {}
+    offsets = np.cumsum([0] + [len(s[2]) for s in smoothed])
+    for i, (name, (x, y, _)) in enumerate(zip(store["name"], smoothed)):
+        halftimes[name] = _halftimes(x, y, finals[offsets[i] : offsets[i + 1]])
+    return halftimes
+
+
 def scatterplot_range(df):
     logger.info("Starting scatterplot_range")
-    names = df["Name"].unique()
+    store = as_store(df)
 
-    max_range = -1
+    ranges = np.nanmax(store["mean"], axis=1) - np.nanmin(store["mean"], axis=1)
 
-    for i in names:
+    return np.nanmax(ranges, initial=-1)
 
-        df_name = df[df["Name"] == i]
-        range = df_name["Mean_gray"].max() - df_name["Mean_gray"].min()
 
-        if range > max_range:
-            max_range = range
+def _scatterplot_figure(
+    name, x, y, color, figsize, yrange, output_path, dpi=300, fmt="png", signal="gray"
+):
+    from matplotlib.figure import Figure
 
-    return max_range
+    # Explicit Figure instead of pyplot, nothing global is kept alive after saving
+    fig = Figure(figsize=figsize)
+    ax = fig.subplots()
+
+    ax.scatter(x, y, c=color)
+    ax.set_xlabel("Time [h]")
+    # signal is the color feature the curves are of, see signal_store
+    label = "grayscale" if signal == "gray" else signal
+    ax.set_ylabel(f"{label.capitalize()} value")
+    ax.set_title(f"Mean {label} values for sample {name}")
+
+    if yrange:
+        if isinstance(yrange, tuple):
+            ax.set_ylim(yrange)
+        else:
+            difference = yrange - (y.max() - y.min())
+
+            ax.set_ylim(bottom=y.min() - difference / 2, top=y.max() + difference / 2)
+
+    file_path = os.path.join(output_path, f"scatterplot_{name}.{fmt}")
+    fig.savefig(file_path, dpi=dpi)
+    return file_path
 
 
 def scatterplot(
@@ -82,102 +213,203 @@ def scatterplot(
     figsize: Optional[Tuple[int, int]] = None,
     yrange: Optional[Union[Tuple[int, int], int]] = None,
     output_path: str = None,
+    dpi: int = 300,
+    fmt: str = "png",
+    signal: str = "gray",
 ) -> None:
     logger.info(f"Creating scatterplot for {name}...")
 
     try:
-        if type(df) == str:
-            df = pd.read_csv(df)
+        store = as_store(df)
+
+        i = store["name"].index(name)
+        present = ~np.isnan(store["mean"][i])
+        y = store["mean"][i][present]
+        x = store["time"][present] / 60
+
+        _scatterplot_figure(
+            name,
+            x,
+            y,
+            store["color"][i],
+            figsize,
+            yrange,
+            output_path,
+            dpi,
+            fmt,
+            signal,
+        )
 
-        df = df[df["Name"] == name]
-        y = df["Mean_gray"]
-        x = df["Time"] / 60
+    except Exception as e:
+        logger.error(f"Error: {e}", exc_info=True)
 
-        if figsize:
-            plt.figure(figsize=figsize)
-        else:
-            plt.figure()
 
-        plt.scatter(x, y, c=df["Color"])
-        plt.xlabel("Time [h]")
-        plt.ylabel("Grayscale value")
-        plt.title(f"Mean grayscale values for sample {name}")
+def boxplot_values(
+    df, name, workers=None, backend="ruptures", seed=None, ci_method="percentile"
+) -> list:
+    logger.info(f"Calculating boxplot values for {name}...")
 
-        if yrange:
-            if isinstance(yrange, tuple):
-                plt.ylim(yrange)
-            else:
-                difference = yrange - (y.max() - y.min())
+    try:
+        x, grays = sample_curves(as_store(df), name)
 
-                plt.ylim(ymin=y.min() - difference / 2, ymax=y.max() + difference / 2)
+        h_times = batch_halftimes(x, grays, workers=workers, backend=backend)
+        halftimes = h_times[~np.isnan(h_times)].tolist()
 
-        file_path = os.path.join(output_path, f"scatterplot_{name}.png")
-        plt.savefig(file_path, dpi=300)
+        conf_interval = bootstrap_mean(halftimes, seed=seed, method=ci_method)
+        return halftimes, conf_interval
 
     except Exception as e:
         logger.error(f"Error: {e}", exc_info=True)
 
 
-def boxplot_values(df, name) -> list:
-    logger.info(f"Calculating boxplot values for {name}...")
+def boxplot_data(
+    df,
+    workers=None,
+    backend="ruptures",
+    seed=None,
+    ci_method="percentile",
+    metrics=None,
+    executor=None,
+):
+    """
+    Halftimes and bootstrap confidence interval of every sample, without plotting.
+    """
+    store = as_store(df)
 
-    try:
-        if type(df) == str:
-            df = pd.read_csv(df)
+    names = store["name"]
+    with stage(metrics, "halftime"):
+        all_halftimes = store_halftimes(
+            store, workers=workers, backend=backend, executor=executor
+        )
 
-        df = df[df["Name"] == name]
+    data = []
+    lables = []
 
-        halftimes = []
+    for name in names:
+        h_times = all_halftimes[name]
+        data.append(h_times[~np.isnan(h_times)].tolist())
+        lables.append(name)
 
-        for i in range(len(ast.literal_eval(df["Gray"].tolist()[0]))):
-            x = []
-            y = []
-            for _, row in df.iterrows():
-                x.append(row["Time"])
-                y.append(ast.literal_eval(row["Gray"])[i])
+    logger.info("Bootstrapping the halftimes of all samples.")
+    with stage(metrics, "bootstrap"):
+        conf_intervals = bootstrap_means(data, seed=seed, method=ci_method)
+    count(
+        metrics,
+        "halftimes_failed",
+        sum(np.isnan(h).sum() for h in all_halftimes.values()),
+    )
 
-            h_time = halftime(x, y)
-            if h_time == False:
-                continue
-            else:
-                halftimes.append(h_time)
+    return data, lables, conf_intervals
 
-        conf_interval = bootstrap_mean(halftimes)
-        return halftimes, conf_interval
 
-    except Exception as e:
-        logger.error(f"Error: {e}", exc_info=True)
+def _boxplot_figure(data, lables, output_path, dpi=300, fmt="png"):
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(12, 8))
+    ax = fig.subplots()
+
+    ax.boxplot(data, patch_artist=True)
+    ax.set_xticks(range(1, len(lables) + 1), lables, rotation=45)
+    ax.set_ylabel("Halftimes")
+    ax.set_xlabel("Samples")
 
+    file_path = os.path.join(output_path, f"boxplot.{fmt}")
+    fig.savefig(file_path, dpi=dpi)
+    return file_path
 
-def boxplot(df, output_path: str) -> None:
+
+def boxplot(
+    df,
+    output_path: str,
+    workers=None,
+    backend="ruptures",
+    seed=None,
+    ci_method="percentile",
+    dpi: int = 300,
+    fmt: str = "png",
+) -> None:
     logger.info("Generating boxplot.")
 
     try:
-        if type(df) == str:
-            df = pd.read_csv(df)
+        data, lables, conf_intervals = boxplot_data(
+            df, workers, backend, seed, ci_method
+        )
+        _boxplot_figure(data, lables, output_path, dpi, fmt)
 
-        names = df["Name"].unique()
+        return lables, conf_intervals
+
+    except Exception as e:
+        logger.error(f"Error: {e}", exc_info=True)
 
-        data = []
-        lables = []
-        conf_intervals = []
 
-        for name in names:
-            halftimes, conf_interval = boxplot_values(df, name)
-            data.append(halftimes)
-            lables.append(name)
-            conf_intervals.append(conf_interval)
+def render_plots(
+    df,
+    output_path: str,
+    yrange=None,
+    halftime_data=None,
+    dpi: int = 300,
+    fmt: str = "png",
+    workers=None,
+    figsize: Optional[Tuple[int, int]] = None,
+    executor=None,
+    signal: str = "gray",
+) -> None:
+    """
+    Render the scatterplot of every sample to output_path/scatterplots and, if the
+    (data, lables) of boxplot_data are given, the boxplot to output_path/boxplots.
+    The figures are rendered in a process pool (or executor if one is given),
+    fmt "none" skips the plotting. signal names the values of the store for the
+    axis label and title, see signal_store.
+    """
+    if fmt == "none":
+        return
 
-        plt.figure(figsize=(12, 8))
-        plt.boxplot(data, labels=lables, patch_artist=True)
+    logger.info(f"Rendering plots as {fmt} with dpi={dpi}.")
 
-        plt.xticks(rotation=45)
-        plt.ylabel("Halftimes")
-        plt.xlabel("Samples")
-        file_path = os.path.join(output_path, f"boxplot.png")
-        plt.savefig(file_path, dpi=300)
+    try:
+        store = as_store(df)
+        scatter_path = os.path.join(output_path, "scatterplots")
 
-        return lables, conf_intervals
+        if executor is None:
+            pool = futures.ProcessPoolExecutor(max_workers=workers)
+        else:
+            pool = nullcontext(executor)
+
+        with pool as ex:
+            jobs = []
+            for i, name in enumerate(store["name"]):
+                present = ~np.isnan(store["mean"][i])
+                jobs.append(
+                    ex.submit(
+                        _scatterplot_figure,
+                        name,
+                        store["time"][present] / 60,
+                        store["mean"][i][present],
+                        store["color"][i],
+                        figsize,
+                        yrange,
+                        scatter_path,
+                        dpi,
+                        fmt,
+                        signal,
+                    )
+                )
+
+            if halftime_data is not None:
+                data, lables = halftime_data
+                jobs.append(
+                    ex.submit(
+                        _boxplot_figure,
+                        data,
+                        lables,
+                        os.path.join(output_path, "boxplots"),
+                        dpi,
+                        fmt,
+                    )
+                )
+
+            for job in jobs:
+                job.result()
 
     except Exception as e:
         logger.error(f"Error: {e}", exc_info=True)
@@ -0,0 +1,163 @@
+import os
+import cv2
+import numpy as np
+import pandas as pd
+from concurrent import futures
+from numpy.lib.stride_tricks import sliding_window_view
+import logging
+from scripts.image_analysis import pictures
+from scripts.metrics import count
+
+logger = logging.getLogger(__name__)
+
+# Frame quality prefilter. Every picture is checked with cheap statistics before
+# the ROIs are extracted: the JPEG end marker, the file size and a 1/8 grayscale
+# decode for the brightness, the saturated pixels and a small thumbnail. A frame
+# is compared to the median of its neighbours in time, so the slow change of the
+# colors passes while a flash, a dark frame or a hand in the picture doesn't.
+
+THUMBNAIL_SIZE = (64, 64)
+
+
+def _frame_stats(image_path):
+    size = os.path.getsize(image_path)
+    truncated = False
+    if image_path.lower().endswith((".jpg", ".jpeg")):
+        # A complete JPEG ends with the end of image marker
+        with open(image_path, "rb") as f:
+            f.seek(max(0, size - 2))
+            truncated = f.read() != b"\xff\xd9"
+
+    image = cv2.imread(image_path, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if image is None:
+        return size, truncated, np.nan, np.nan, None
+
+    thumbnail = cv2.resize(image, THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA)
+    return size, truncated, image.mean(), (image >= 250).mean(), thumbnail
+
+
+def _rolling_median(values, window):
+    # Centered median over time, the ends are padded with the edge values
+    pad = [(window // 2, window // 2)] + [(0, 0)] * (values.ndim - 1)
+    padded = np.pad(values, pad, mode="edge")
+    return np.median(sliding_window_view(padded, window, axis=0), axis=-1)
+
+
+def _robust_outliers(values, k):
+    # Values more than k robust standard deviations above the median
+    median = np.nanmedian(values)
+    spread = 1.4826 * np.nanmedian(np.abs(values - median))
+    return values > median + k * max(spread, 1e-9)
+
+
+def check_frames(
+    folder_path,
+    workers=None,
+    window=7,
+    size_ratio=0.5,
+    brightness_tolerance=0.2,
+    saturation_limit=0.05,
+    drift_threshold=6.0,
+    min_drift=4.0,
+):
+    """
+    Quality statistics of every picture in folder_path as a DataFrame with the
+    filename, size, brightness, saturated fraction, drift and the reason the frame
+    should be skipped ("" for good frames). Reasons:
+      unreadable   the picture can't be decoded
+      truncated    the JPEG has no end marker, the camera didn't finish writing
+      small_file   smaller than size_ratio times the median of its neighbours
+      dark, bright brightness more than brightness_tolerance from its neighbours
+      saturated    more than saturation_limit of the pixels are saturated
+      drift        the picture differs much more from its neighbours than usual
+    """
+    logger.info(f"Checking the quality of the pictures in {folder_path}.")
+    filenames = [filename for _, filename in pictures(folder_path)]
+    if not filenames:
+        return pd.DataFrame(
+            columns=["filename", "size", "brightness", "saturated", "drift", "reason"]
+        )
+
+    with futures.ThreadPoolExecutor(max_workers=workers) as ex:
+        stats = list(
+            ex.map(_frame_stats, [os.path.join(folder_path, f) for f in filenames])
+        )
+
+    size = np.array([s[0] for s in stats], dtype=np.float64)
+    truncated = np.array([s[1] for s in stats])
+    brightness = np.array([s[2] for s in stats])
+    saturated = np.array([s[3] for s in stats])
+    readable = ~np.isnan(brightness)
+    window = min(window, len(filenames)) | 1
+
+    # Compare every frame to the median of its neighbours in time
+    reference_size = _rolling_median(size, window)
+    reference_brightness = _rolling_median(
+        np.where(readable, brightness, np.nanmedian(brightness)), window
+    )
+
+    drift = np.full(len(filenames), np.nan)
+    if readable.any():
+        blank = np.zeros(THUMBNAIL_SIZE[::-1], dtype=np.uint8)
+        thumbnails = np.stack(
+            [s[4] if s[4] is not None else blank for s in stats]
+        ).astype(np.float64)
+        # Without the overall brightness, which the brightness check covers
+        thumbnails -= thumbnails.mean(axis=(1, 2), keepdims=True)
+        reference = _rolling_median(thumbnails, window)
+        drift = np.abs(thumbnails - reference).mean(axis=(1, 2))
+        drift[~readable] = np.nan
+
+    with np.errstate(invalid="ignore"):
+        change = brightness / reference_brightness - 1
+        drifted = _robust_outliers(drift, drift_threshold) & (drift > min_drift)
+
+    # The first matching reason is reported
+    reason = np.select(
+        [
+            ~readable,
+            truncated,
+            size < size_ratio * reference_size,
+            change < -brightness_tolerance,
+            change > brightness_tolerance,
+            saturated > saturation_limit,
+            drifted,
+        ],
+        [
+            "unreadable",
+            "truncated",
+            "small_file",
+            "dark",
+            "bright",
+            "saturated",
+            "drift",
+        ],
+        default="",
+    )
+
+    return pd.DataFrame(
+        {
+            "filename": filenames,
+            "size": size.astype(np.int64),
+            "brightness": brightness,
+            "saturated": saturated,
+            "drift": drift,
+            "reason": reason,
+        }
+    )
+
+
+def prefilter(folder_path, output_path, workers=None, metrics=None):
+    """
+    Check the pictures and write the ones to skip, with their reason and
+    statistics, to output_path/skipped_frames.csv. Returns the set of filenames
+    to skip.
+    """
+    frames = check_frames(folder_path, workers)
+    skipped = frames[frames["reason"] != ""]
+    skipped.to_csv(os.path.join(output_path, "skipped_frames.csv"), index=False)
+
+    for reason, n in skipped["reason"].value_counts().items():
+        logger.warning(f"Skipping {n} pictures: {reason}.")
+    count(metrics, "frames_skipped", len(skipped))
+    return set(skipped["filename"])
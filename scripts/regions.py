@@ -0,0 +1,199 @@
+import os
+import cv2
+import numpy as np
+import pandas as pd
+import logging
+from scripts.image_analysis import DECODE_MODES, read_frame
+
+logger = logging.getLogger(__name__)
+
+# Sample regions are found in a reference picture with the developed colors. The
+# picture is decoded at a reduced resolution, every pixel gets its Lab color
+# distance to the background (the median color of the border of the picture),
+# with the lightness difference weighed down because plate rims, labels and
+# uneven light differ from the background mostly in lightness. The distance is
+# thresholded with Otsu and cleaned up with an opening and a closing, and every
+# connected component of the right size is a region.
+#
+# regions.png holds the label of every pixel at the detection resolution (0 is
+# background) and regions.csv the label, name, color, centroid (x is the image
+# row, y the column, like the coords csv), area in full resolution pixels and the
+# scale of the label image. Points for a coords csv are sampled inside every
+# region, away from its edge so the ROIs stay inside, or every region becomes a
+# mask ROI that covers all of its pixels.
+
+REGIONS_FILE = "regions.csv"
+LABELS_FILE = "regions.png"
+
+
+def _foreground(image, lightness=0.25, border=0.05, blur=2.0):
+    # Pixels whose color differs from the background more than Otsu's threshold,
+    # lightness weighs the L difference against the a and b differences
+    lab = cv2.cvtColor(image, cv2.COLOR_BGR2LAB).astype(np.float32)
+    h, w = lab.shape[:2]
+    b = max(1, int(min(h, w) * border))
+    band = np.concatenate(
+        [
+            lab[:b].reshape(-1, 3),
+            lab[-b:].reshape(-1, 3),
+            lab[:, :b].reshape(-1, 3),
+            lab[:, -b:].reshape(-1, 3),
+        ]
+    )
+    difference = lab - np.median(band, axis=0)
+    difference[..., 0] *= np.sqrt(lightness)
+    distance = np.linalg.norm(difference, axis=2)
+    distance = cv2.GaussianBlur(distance, (0, 0), blur)
+
+    scaled = (distance * (255 / max(distance.max(), 1e-9))).astype(np.uint8)
+    _, mask = cv2.threshold(scaled, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    return mask
+
+
+def detect_regions(
+    image_path,
+    decode="reduced8",
+    min_area=0.001,
+    max_area=0.25,
+    smooth=3,
+    lightness=0.25,
+):
+    """
+    Find the sample regions in a reference picture. Returns the label image at
+    the decode resolution and a DataFrame with the label, name, color, x, y, area
+    and scale of every region, in reading order. min_area and max_area are
+    fractions of the picture, smooth is the size of the opening and closing and
+    lightness the weight of lightness differences against color differences
+    (raise it for samples that darken without changing color).
+    """
+    logger.info(f"Detecting regions in {image_path}.")
+    image = read_frame(image_path, decode)
+    if image is None:
+        raise ValueError(f"Could not read {image_path}.")
+    scale = DECODE_MODES[decode][1]
+
+    mask = _foreground(image, lightness)
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (smooth, smooth))
+    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
+
+    n, labels, stats, centroids = cv2.connectedComponentsWithStats(mask, 8)
+    h, w = mask.shape
+    area = stats[:, cv2.CC_STAT_AREA]
+    keep = np.flatnonzero((area >= min_area * h * w) & (area <= max_area * h * w))
+    keep = keep[keep != 0]
+
+    # Reading order, top to bottom in bands of a tenth of the picture
+    band = np.round(centroids[keep, 1] / (h / 10))
+    keep = keep[np.lexsort((centroids[keep, 0], band))]
+
+    relabel = np.zeros(n, dtype=np.uint16)
+    relabel[keep] = np.arange(1, len(keep) + 1)
+    labels = relabel[labels]
+
+    regions = pd.DataFrame(
+        {
+            "label": np.arange(1, len(keep) + 1),
+            "name": [f"region_{i}" for i in range(1, len(keep) + 1)],
+            "color": [f"C{i % 10}" for i in range(len(keep))],
+            # x is the image row and y the column, like the coords csv
+            "x": ((centroids[keep, 1] + 0.5) * scale).astype(np.int64),
+            "y": ((centroids[keep, 0] + 0.5) * scale).astype(np.int64),
+            "area": area[keep] * scale * scale,
+            "scale": scale,
+        }
+    )
+    logger.info(f"Found {len(regions)} regions.")
+    return labels, regions
+
+
+def region_points(labels, regions, n_points=20, roi_size=5, seed=0):
+    """
+    Coords csv DataFrame (name, color, x, y) with up to n_points random points in
+    every region, at least roi_size full resolution pixels from its edge if the
+    region is large enough.
+    """
+    rng = np.random.default_rng(seed)
+    rows = []
+    for region in regions.itertuples():
+        mask = (labels == region.label).astype(np.uint8)
+        margin = int(np.ceil(roi_size / region.scale))
+        if margin > 0:
+            kernel = np.ones((2 * margin + 1, 2 * margin + 1), dtype=np.uint8)
+            inner = cv2.erode(mask, kernel)
+            if inner.any():
+                mask = inner
+
+        r, c = np.nonzero(mask)
+        if not len(r):
+            logger.warning(f"Region {region.name} is empty, skipping.")
+            continue
+        chosen = rng.choice(len(r), size=min(n_points, len(r)), replace=False)
+        for i in np.sort(chosen):
+            rows.append(
+                (
+                    region.name,
+                    region.color,
+                    int((r[i] + 0.5) * region.scale),
+                    int((c[i] + 0.5) * region.scale),
+                )
+            )
+    return pd.DataFrame(rows, columns=["name", "color", "x", "y"])
+
+
+def region_masks(regions):
+    """
+    Coords csv DataFrame with one mask ROI per region, so the analysis measures
+    every pixel of the region. It refers to the label image by its name, so it
+    has to be saved next to it.
+    """
+    return pd.DataFrame(
+        {
+            "name": regions["name"],
+            "color": regions["color"],
+            "x": regions["x"],
+            "y": regions["y"],
+            "shape": "mask",
+            "mask": LABELS_FILE,
+            "label": regions["label"],
+        }
+    )
+
+
+def save_regions(output_path, labels, regions):
+    os.makedirs(output_path, exist_ok=True)
+    cv2.imwrite(os.path.join(output_path, LABELS_FILE), labels.astype(np.uint16))
+    regions.to_csv(os.path.join(output_path, REGIONS_FILE), index=False)
+
+
+def load_regions(path):
+    """
+    Label image and regions DataFrame from a directory written by save_regions.
+    """
+    labels = cv2.imread(os.path.join(path, LABELS_FILE), cv2.IMREAD_UNCHANGED)
+    if labels is None:
+        raise ValueError(f"No {LABELS_FILE} in {path}.")
+    regions = pd.read_csv(os.path.join(path, REGIONS_FILE))
+    return labels, regions
+
+
+def overview(image_path, labels, regions, output_file, decode="reduced8"):
+    """
+    Save the reference picture with the outline and label of every region, to
+    check the detection without the GUI.
+    """
+    image = read_frame(image_path, decode)
+    for region in regions.itertuples():
+        mask = (labels == region.label).astype(np.uint8)
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        cv2.drawContours(image, contours, -1, (0, 0, 255), 1)
+        cv2.putText(
+            image,
+            str(region.label),
+            (int(region.y / region.scale), int(region.x / region.scale)),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            0.5,
+            (0, 0, 255),
+            1,
+        )
+    cv2.imwrite(output_file, image)
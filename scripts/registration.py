@@ -0,0 +1,140 @@
+import os
+import cv2
+import numpy as np
+import pandas as pd
+import logging
+from scripts.image_analysis import DECODE_MODES, pictures, read_frame
+from scripts.metrics import count
+
+logger = logging.getLogger(__name__)
+
+# Drift correction. Over long runs the plate can shift a few pixels, so the ROIs
+# are moved with it. Every frame is compared to a reference frame (the first
+# readable picture) by phase correlation on a grayscale image at 1/8 of the full
+# resolution, taken from the frame that is decoded for the ROIs anyway. The
+# offsets (dx along the image columns, dy along the image rows, in full
+# resolution pixels) are kept in registration.csv in the run directory, so a
+# rerun only registers new or changed pictures.
+
+OFFSETS_FILE = "registration.csv"
+REGISTRATION_SCALE = 8
+# Frames that correlate worse than this with the reference, or that seem to have
+# moved further than MAX_DRIFT full resolution pixels, are not shifted
+MIN_RESPONSE = 0.1
+MAX_DRIFT = 250
+
+
+def _stamp(image_path):
+    stat = os.stat(image_path)
+    return f"{stat.st_mtime_ns}|{stat.st_size}"
+
+
+def registration_image(image, scale=1):
+    """
+    Grayscale image at 1/REGISTRATION_SCALE of the full resolution of a frame
+    decoded at 1/scale. Every nth pixel is taken, which costs almost nothing.
+    """
+    step = max(1, REGISTRATION_SCALE // scale)
+    small = np.ascontiguousarray(image[::step, ::step])
+    if small.ndim == 3:
+        small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    return small
+
+
+def frame_offset(image, reference, scale=1):
+    """
+    Shift (dx, dy) of a frame against the reference in full resolution pixels,
+    and the phase correlation response. The response is 0 if the frame has
+    another size than the reference.
+    """
+    small = registration_image(image, scale)
+    if small.shape != reference.shape:
+        return 0.0, 0.0, 0.0
+
+    window = cv2.createHanningWindow(reference.shape[::-1], cv2.CV_32F)
+    (dx, dy), response = cv2.phaseCorrelate(
+        reference.astype(np.float32), small.astype(np.float32), window
+    )
+    factor = max(1, REGISTRATION_SCALE // scale) * scale
+    return dx * factor, dy * factor, response
+
+
+def _reliable(offset):
+    dx, dy, response = offset
+    return response >= MIN_RESPONSE and np.hypot(dx, dy) <= MAX_DRIFT
+
+
+def plan_shift(offset):
+    """
+    Whole pixel shift of the ROI plan for an offset, no shift if it's unreliable.
+    """
+    if not _reliable(offset):
+        return 0, 0
+    return int(round(offset[0])), int(round(offset[1]))
+
+
+def load_registration(folder_path, output_path, decode="full", skip=None):
+    """
+    Reference frame and the cached offsets of a run as a dict with the folder_path,
+    reference (filename), key (identifies the reference for the frame cache), image
+    (the registration image of the reference) and offsets (filename to
+    (dx, dy, response)). Offsets of pictures that changed since they were
+    registered, or that were registered against another reference, are dropped.
+    """
+    filenames = [f for _, f in pictures(folder_path) if f not in (skip or ())]
+    for reference in filenames:
+        image = read_frame(os.path.join(folder_path, reference), decode)
+        if image is not None:
+            break
+    else:
+        raise ValueError(f"No readable picture in {folder_path} to register against.")
+
+    stamp = _stamp(os.path.join(folder_path, reference))
+    offsets = {reference: (0.0, 0.0, 1.0)}
+
+    path = os.path.join(output_path, OFFSETS_FILE)
+    if os.path.exists(path):
+        cached = pd.read_csv(path, dtype={"stamp": str})
+        if len(cached) and tuple(cached.iloc[0][["filename", "stamp"]]) == (
+            reference,
+            stamp,
+        ):
+            for row in cached.itertuples():
+                image_path = os.path.join(folder_path, row.filename)
+                if os.path.exists(image_path) and _stamp(image_path) == row.stamp:
+                    offsets[row.filename] = (row.dx, row.dy, row.response)
+        logger.info(f"Reusing the offsets of {len(offsets) - 1} pictures.")
+
+    return {
+        "folder_path": folder_path,
+        "reference": reference,
+        "key": f"{os.path.abspath(os.path.join(folder_path, reference))}|{stamp}",
+        "image": registration_image(image, DECODE_MODES[decode][1]),
+        "offsets": offsets,
+    }
+
+
+def save_registration(registration, output_path, metrics=None):
+    """
+    Write the offsets to output_path/registration.csv, the reference first.
+    """
+    folder_path, reference = registration["folder_path"], registration["reference"]
+    offsets = registration["offsets"]
+    filenames = [reference] + sorted(f for f in offsets if f != reference)
+
+    rows = []
+    for filename in filenames:
+        image_path = os.path.join(folder_path, filename)
+        if os.path.exists(image_path):
+            rows.append((filename, _stamp(image_path), *offsets[filename]))
+    df = pd.DataFrame(rows, columns=["filename", "stamp", "dx", "dy", "response"])
+    df.to_csv(os.path.join(output_path, OFFSETS_FILE), index=False)
+
+    unregistered = sum(not _reliable(offset) for offset in offsets.values())
+    if unregistered:
+        logger.warning(
+            f"{unregistered} pictures don't match the reference {reference}, their ROIs are not shifted."
+        )
+    count(metrics, "frames_unregistered", unregistered)
+    drift = [np.hypot(*offset[:2]) for offset in offsets.values() if _reliable(offset)]
+    logger.info(f"Largest drift {max(drift):.1f} pixels from {reference}.")
@@ -0,0 +1,295 @@
+import os
+import ast
+import csv
+import heapq
+import warnings
+import numpy as np
+import pandas as pd
+import logging
+from scripts.image_analysis import parse_features
+
+logger = logging.getLogger(__name__)
+
+# The results are kept as a dict of dense arrays instead of the long csv format:
+#   time      (T,)        minutes, sorted
+#   name      (S,)        sample names in the order of the coords file
+#   color     (S,)        scatterplot color of each sample
+#   n_points  (S,)        number of points of each sample
+#   mean      (S, T)      mean gray value of each sample
+#   gray      (S, P, T)   gray value of each point
+#   features  (F,)        names of the measured color features, usually empty
+#   <feature> (S, P, T)   value of each color feature of each point
+# Points past n_points and frames missing for a sample are NaN.
+
+COLUMNS = ["Time", "Name", "Color", "Mean_gray", "Gray"]
+
+
+def results_to_store(results, features=None):
+    """
+    Build the results store from the (time, name, color, mean_gray, grays) rows
+    returned by process_images. With color features the rows have the values of
+    every feature as a sixth element, in the order of parse_features.
+    Frames with the same time (e.g. burst shots, or a camera clock with whole
+    seconds) are kept as separate frames in the order of their rows.
+    """
+    features = parse_features(features)[1:]
+    names, colors, n_points = [], [], []
+    for _, name, color, _, grays, *_ in results:
+        if name not in names:
+            names.append(name)
+            colors.append(color)
+            n_points.append(len(grays))
+
+    # The k-th row of a sample at a time belongs to the k-th frame with that time
+    repeats = {}
+    frames = []
+    for time, name, *_ in results:
+        k = repeats.get((time, name), 0)
+        repeats[(time, name)] = k + 1
+        frames.append((time, k))
+    columns = {frame: t for t, frame in enumerate(sorted(set(frames)))}
+    times = np.array([time for time, _ in columns], dtype=np.float64)
+    shared = sum(k > 0 for _, k in columns)
+    if shared:
+        logger.warning(
+            f"{shared} frames have the same time as another frame, keeping them in frame order."
+        )
+    n_p = max(n_points, default=0)
+
+    mean = np.full((len(names), len(times)), np.nan)
+    gray = np.full((len(names), n_p, len(times)), np.nan)
+    values = np.full((len(features), len(names), n_p, len(times)), np.nan)
+
+    sample = {name: i for i, name in enumerate(names)}
+    for (time, name, _, mean_gray, grays, *extra), frame in zip(results, frames):
+        i, t = sample[name], columns[frame]
+        mean[i, t] = mean_gray
+        gray[i, : len(grays), t] = grays
+        if features:
+            values[:, i, : len(grays), t] = extra[0]
+
+    store = {
+        "time": times,
+        "name": names,
+        "color": colors,
+        "n_points": np.array(n_points, dtype=np.int64),
+        "mean": mean,
+        "gray": gray,
+        "features": features,
+    }
+    store.update(zip(features, values))
+    return store
+
+
+def open_writer(path, features=None, write_csv=True, buffer=16, flush_every=20):
+    """
+    Writer that takes the rows of every frame as it is analysed (see write_frame)
+    and builds the results store without reading results.csv back. With write_csv
+    the rows are also written to path/results.csv in time order: up to buffer
+    frames are held back to put frames that finish out of order back in order,
+    and the file is flushed every flush_every frames so an interrupted run keeps
+    its rows.
+    """
+    features = parse_features(features)[1:]
+    writer = {
+        "features": features,
+        "buffer": buffer,
+        "flush_every": flush_every,
+        "pending": [],
+        "rows": [],
+        "seen": 0,
+        "frames": 0,
+        "last_time": -np.inf,
+        "sorted": True,
+        "path": path,
+        "file": None,
+    }
+    if write_csv:
+        logger.info(f"Streaming image analysis results to results.csv at {path}.")
+        writer["file"] = open(os.path.join(path, "results.csv"), "w", newline="")
+        writer["csv"] = csv.writer(writer["file"], lineterminator="\n")
+        writer["csv"].writerow(COLUMNS + features)
+    return writer
+
+
+def _emit(writer, rows):
+    # Write the rows of the earliest held back frame
+    time = rows[0][0]
+    if time < writer["last_time"]:
+        writer["sorted"] = False
+    writer["last_time"] = max(writer["last_time"], time)
+    writer["rows"].extend(rows)
+    writer["frames"] += 1
+
+    if writer["file"] is not None:
+        for time, name, color, mean_gray, grays, *extra in rows:
+            values = tuple(extra[0]) if extra else ()
+            writer["csv"].writerow((time, name, color, mean_gray, grays) + values)
+        if writer["frames"] % writer["flush_every"] == 0:
+            writer["file"].flush()
+
+
+def write_frame(writer, rows):
+    """
+    Add the result rows of one frame, as returned by frame_rows.
+    """
+    if not rows:
+        return
+    # Frames with the same time keep the order they came in
+    heapq.heappush(writer["pending"], (rows[0][0], writer["seen"], rows))
+    writer["seen"] += 1
+    while len(writer["pending"]) > writer["buffer"]:
+        _emit(writer, heapq.heappop(writer["pending"])[-1])
+
+
+def close_writer(writer):
+    """
+    Write the held back frames, close results.csv and return the results store.
+    """
+    written = writer["file"] is not None
+    try:
+        while writer["pending"]:
+            _emit(writer, heapq.heappop(writer["pending"])[-1])
+    finally:
+        if written:
+            writer["file"].close()
+            writer["file"] = None
+
+    store = results_to_store(writer["rows"], writer["features"])
+    if written and not writer["sorted"]:
+        # A frame came more than buffer frames late, write the file again
+        logger.warning("Frames arrived out of order, rewriting results.csv.")
+        export_csv(store, writer["path"])
+    return store
+
+
+def stream_results(frames, path, features=None, write_csv=True, buffer=16):
+    """
+    Write the rows of every frame of an iterable (one list of rows per frame) and
+    return the results store.
+    """
+    writer = open_writer(path, features, write_csv, buffer)
+    try:
+        for rows in frames:
+            write_frame(writer, rows)
+    finally:
+        store = close_writer(writer)
+    return store
+
+
+def store_from_frame(df):
+    """
+    Build the results store from a results.csv DataFrame, parsing every Gray list once.
+    """
+    # Every column after the standard ones is a color feature
+    features = [column for column in df.columns if column not in COLUMNS]
+    columns = [df["Gray"].map(ast.literal_eval)]
+    columns += [df[feature].map(ast.literal_eval) for feature in features]
+
+    rows = []
+    for time, name, color, mean_gray, grays, *extra in zip(
+        df["Time"], df["Name"], df["Color"], df["Mean_gray"], *columns
+    ):
+        row = (time, name, color, mean_gray, grays)
+        rows.append(row + (extra,) if extra else row)
+    return results_to_store(rows, features)
+
+
+def store_to_frame(store):
+    """
+    Long format DataFrame in the layout of results.csv, sorted by time.
+    """
+    features = list(store.get("features", []))
+    rows = []
+    for t, time in enumerate(store["time"]):
+        for i, name in enumerate(store["name"]):
+            if np.isnan(store["mean"][i, t]):
+                continue
+
+            n = store["n_points"][i]
+            grays = store["gray"][i, :n, t]
+            rows.append(
+                (time, name, store["color"][i], store["mean"][i, t], grays.tolist())
+                + tuple(store[feature][i, :n, t].tolist() for feature in features)
+            )
+    return pd.DataFrame(rows, columns=COLUMNS + features)
+
+
+def save_store(store, path):
+    logger.info(f"Writing image analysis results to results.npz at {path}.")
+    output_file = os.path.join(path, "results.npz")
+    features = list(store.get("features", []))
+    np.savez(
+        output_file,
+        time=store["time"],
+        name=np.array(store["name"], dtype=str),
+        color=np.array(store["color"], dtype=str),
+        n_points=store["n_points"],
+        mean=store["mean"],
+        gray=store["gray"],
+        features=np.array(features, dtype=str),
+        **{feature: store[feature] for feature in features},
+    )
+    return output_file
+
+
+def export_csv(store, path):
+    logger.info(f"Exporting image analysis results to results.csv at {path}.")
+    output_file = os.path.join(path, "results.csv")
+    store_to_frame(store).to_csv(output_file, index=False)
+    return output_file
+
+
+def load_store(path):
+    """
+    Load a results store from results.npz, or from an older results.csv.
+    """
+    if path.endswith(".csv"):
+        return store_from_frame(pd.read_csv(path))
+
+    with np.load(path) as data:
+        store = {key: data[key] for key in data.files}
+    store["name"] = store["name"].tolist()
+    store["color"] = store["color"].tolist()
+    store["features"] = store["features"].tolist() if "features" in store else []
+    return store
+
+
+def as_store(data):
+    """
+    Accept a results store, a results DataFrame or a path to either.
+    """
+    if isinstance(data, str):
+        return load_store(data)
+    if isinstance(data, pd.DataFrame):
+        return store_from_frame(data)
+    return data
+
+
+def signal_store(store, signal="gray"):
+    """
+    The store with a color feature as the signal: its values replace the gray
+    values and the sample means, so the halftimes, cleaning and plots use it.
+    """
+    if signal == "gray":
+        return store
+    if signal not in store.get("features", []):
+        raise ValueError(f"The results have no {signal} values.")
+
+    values = store[signal]
+    with warnings.catch_warnings():
+        # Frames missing for a sample are NaN for all its points
+        warnings.simplefilter("ignore", RuntimeWarning)
+        mean = np.nanmean(values, axis=1)
+    return dict(
+        store, gray=values, mean=np.where(np.isnan(store["mean"]), np.nan, mean)
+    )
+
+
+def sample_curves(store, name):
+    """
+    Times and (points x times) gray values of one sample, missing frames dropped.
+    """
+    i = store["name"].index(name)
+    present = ~np.isnan(store["mean"][i])
+    return store["time"][present], store["gray"][i, : store["n_points"][i]][:, present]
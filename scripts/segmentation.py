@@ -0,0 +1,75 @@
+import numpy as np
+from math import ceil
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Binary segmentation with a piecewise linear cost, the same greedy search as
+# ruptures.Binseg (min_size, jump and tie breaking included) but with every
+# segment cost computed from prefix sums instead of a least squares fit.
+#
+# The cost of a segment is the residual sum of squares of a line y = a + b * t
+# fitted to it, the same as ruptures' "linear" model when the signal is given as
+# [y, 1, t]. Fitting ruptures' "linear" model on y alone has no covariates, so
+# the cost is just the sum of squares and every split has zero gain.
+
+
+def _prefix_moments(y):
+    # Centered for numerical stability, a line fit does not depend on the offset
+    n = len(y)
+    t = np.arange(n) - (n - 1) / 2
+    yc = y - y.mean()
+    moments = np.column_stack([np.ones(n), t, t * t, yc, t * yc, yc * yc])
+
+    prefix = np.zeros((n + 1, 6))
+    np.cumsum(moments, axis=0, out=prefix[1:])
+    return prefix
+
+
+def _linear_cost(prefix, start, end):
+    n, st, stt, sy, sty, syy = (prefix[end] - prefix[start]).T
+    det = n * stt - st * st
+    return syy - (sy * sy * stt - 2 * sy * sty * st + n * sty * sty) / det
+
+
+def _best_split(prefix, start, end, min_size, jump):
+    bkps = np.arange(start, end, jump)
+    bkps = bkps[(bkps - start >= min_size) & (end - bkps >= min_size)]
+    if len(bkps) == 0:
+        return None, 0
+
+    gains = (
+        _linear_cost(prefix, start, end)
+        - _linear_cost(prefix, start, bkps)
+        - _linear_cost(prefix, bkps, end)
+    )
+    # ruptures keeps the largest breakpoint when gains are equal
+    i = len(gains) - 1 - np.argmax(gains[::-1])
+    return int(bkps[i]), gains[i]
+
+
+def binseg(y, n_bkps=2, min_size=2, jump=5):
+    """
+    Breakpoints of y, sorted and ending with len(y) like ruptures' predict.
+    """
+    y = np.asarray(y, dtype=np.float64)
+    n = len(y)
+
+    if n_bkps > n // jump or n_bkps * ceil(min_size / jump) * jump + min_size > n:
+        raise ValueError(f"Can't place {n_bkps} breakpoints in {n} samples.")
+
+    prefix = _prefix_moments(y)
+    bkps = [n]
+    while len(bkps) - 1 < n_bkps:
+        splits = [
+            _best_split(prefix, start, end, min_size, jump)
+            for start, end in zip([0] + bkps[:-1], bkps)
+        ]
+        bkp, _ = max(splits, key=lambda split: split[1])
+
+        if bkp is None:
+            break
+        bkps.append(bkp)
+        bkps.sort()
+
+    return bkps
@@ -0,0 +1,263 @@
+import os
+import json
+import cv2
+import numpy as np
+import pandas as pd
+from concurrent import futures
+from collections import OrderedDict
+import logging
+from scripts.image_analysis import (
+    DECODE_MODES,
+    pictures,
+    read_frame,
+    build_roi_plan,
+    roi_means,
+    frame_rows,
+    _plan_bounds,
+    _untimed,
+)
+from scripts.metrics import stage, add_time, count, clock, elapsed
+
+logger = logging.getLogger(__name__)
+
+# A frame stack is the timelapse decoded once into a uint8 .npy file of
+# frames x H x W (x 3 for color), optionally cropped to the bounding box of the
+# coordinates plus a margin. stack.json holds the decode mode, the crop box and
+# the size and mtime of every source picture, so a stale stack is rebuilt.
+# Reruns with other ROIs read the frames through a memory map instead of
+# decoding the JPEGs again.
+
+STACK_FILE = "frames.npy"
+META_FILE = "stack.json"
+
+
+def _sources(folder_path):
+    sources = []
+    for _, filename in pictures(folder_path):
+        stat = os.stat(os.path.join(folder_path, filename))
+        sources.append([filename, stat.st_size, stat.st_mtime_ns])
+    return sources
+
+
+def _crop_box(coordinates, shape, scale, margin):
+    # (top, bottom, left, right) in decoded pixels, the whole frame without margin
+    h, w = shape
+    if coordinates is None or margin is None or margin < 0:
+        return [0, h, 0, w]
+
+    df = pd.read_csv(coordinates) if isinstance(coordinates, str) else coordinates
+    # Same orientation as the ROI plan, the csv "y" column indexes image columns
+    rows, cols = df["x"].to_numpy(), df["y"].to_numpy()
+    top = int(np.clip((rows.min() - margin) // scale, 0, h))
+    bottom = int(np.clip(-(-(rows.max() + margin + 1) // scale), 0, h))
+    left = int(np.clip((cols.min() - margin) // scale, 0, w))
+    right = int(np.clip(-(-(cols.max() + margin + 1) // scale), 0, w))
+    return [top, bottom, left, right]
+
+
+def build_stack(
+    folder_path,
+    stack_dir,
+    coordinates=None,
+    decode="full",
+    margin=100,
+    color=False,
+    workers=None,
+    metrics=None,
+):
+    """
+    Decode every picture in folder_path once into stack_dir/frames.npy, grayscale
+    or BGR if color. With coordinates the frames are cropped to their bounding box
+    plus margin full resolution pixels, a negative margin keeps the whole frame.
+    Unreadable pictures are left out. Returns the stack metadata.
+    """
+    logger.info(
+        f"Building frame stack of {folder_path} in {stack_dir} with decode={decode}, margin={margin} and color={color}."
+    )
+    if color and decode.endswith("_gray"):
+        raise ValueError(f"A color stack needs a color decode mode, not {decode}.")
+    os.makedirs(stack_dir, exist_ok=True)
+    # An interrupted build must not leave a stack that looks current
+    if os.path.exists(os.path.join(stack_dir, META_FILE)):
+        os.remove(os.path.join(stack_dir, META_FILE))
+    sources = _sources(folder_path)
+    scale = DECODE_MODES[decode][1]
+
+    def decode_frame(source):
+        start = clock()
+        image = read_frame(os.path.join(folder_path, source[0]), decode)
+        return image, elapsed(start)
+
+    frames = None
+    meta = None
+    kept = []
+    with futures.ThreadPoolExecutor(max_workers=workers) as ex:
+        for (index, source), (image, decode_s) in zip(
+            enumerate(sources), ex.map(decode_frame, sources)
+        ):
+            add_time(metrics, "decode", *decode_s)
+            if frames is None and image is not None:
+                shape = image.shape[:2]
+                box = _crop_box(coordinates, shape, scale, margin)
+                frame_shape = (box[1] - box[0], box[3] - box[2])
+                if color:
+                    frame_shape += (3,)
+                frames = np.lib.format.open_memmap(
+                    os.path.join(stack_dir, STACK_FILE),
+                    mode="w+",
+                    dtype=np.uint8,
+                    shape=(len(sources),) + frame_shape,
+                )
+
+            if image is None or image.shape[:2] != shape:
+                logger.warning(f"Could not read {source[0]}, leaving it out.")
+                count(metrics, "frames_unreadable")
+                continue
+
+            crop = image[box[0] : box[1], box[2] : box[3]]
+            if color or crop.ndim == 2:
+                frames[len(kept)] = crop
+            else:
+                cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY, dst=frames[len(kept)])
+            kept.append([index, source[0]])
+            count(metrics, "frames_decoded")
+
+    if frames is not None:
+        frames.flush()
+        del frames
+        meta = {
+            "folder_path": os.path.abspath(folder_path),
+            "decode": decode,
+            "color": color,
+            "frame_shape": list(shape),
+            "box": box,
+            "n_frames": len(kept),
+            "frames": kept,
+            "sources": sources,
+        }
+        with open(os.path.join(stack_dir, META_FILE), "w") as f:
+            json.dump(meta, f)
+    return meta
+
+
+def open_stack(stack_dir):
+    """
+    The frames of a stack as a read only memory map, and its metadata.
+    """
+    with open(os.path.join(stack_dir, META_FILE)) as f:
+        meta = json.load(f)
+    frames = np.load(os.path.join(stack_dir, STACK_FILE), mmap_mode="r")
+    return frames[: meta["n_frames"]], meta
+
+
+def stack_plan(plan, meta):
+    """
+    The ROI plan moved into the crop box of the stack. Raises ValueError if an ROI
+    reaches outside the crop, as its mean would then differ from the full frame.
+    """
+    if plan["scale"] != DECODE_MODES[meta["decode"]][1]:
+        raise ValueError(f"The stack was decoded with {meta['decode']}.")
+    if plan["shapes"]:
+        raise ValueError("The frame stack only supports square ROIs.")
+
+    top, bottom, left, right = meta["box"]
+    *_, valid, box = _plan_bounds(plan, tuple(meta["frame_shape"]))
+    if valid.any() and (
+        box[0] < top or box[1] > bottom or box[2] < left or box[3] > right
+    ):
+        raise ValueError("The ROIs reach outside the crop of the frame stack.")
+
+    # Floor division by the scale commutes with a shift of a whole decoded pixel
+    f = plan["scale"]
+    return dict(
+        plan,
+        cols=plan["cols"] - left * f,
+        rows=plan["rows"] - top * f,
+        bounds=OrderedDict(),
+        pixels=OrderedDict(),
+        unshifted={},
+    )
+
+
+def stack_is_current(stack_dir, folder_path, decode="full", color=False):
+    try:
+        with open(os.path.join(stack_dir, META_FILE)) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    return (
+        meta["decode"] == decode
+        and meta["color"] == color
+        and meta["folder_path"] == os.path.abspath(folder_path)
+        and meta["sources"] == _sources(folder_path)
+        and os.path.exists(os.path.join(stack_dir, STACK_FILE))
+    )
+
+
+def ensure_stack(
+    stack_dir,
+    folder_path,
+    coordinates,
+    roi_size=5,
+    decode="full",
+    margin=100,
+    color=False,
+    workers=None,
+    metrics=None,
+):
+    """
+    Build the stack unless an up to date one that covers every ROI exists.
+    """
+    if build_roi_plan(coordinates, roi_size, decode)["shapes"]:
+        raise ValueError("The frame stack only supports square ROIs.")
+    if stack_is_current(stack_dir, folder_path, decode, color):
+        _, meta = open_stack(stack_dir)
+        try:
+            stack_plan(build_roi_plan(coordinates, roi_size, decode), meta)
+            logger.info(f"Reusing the frame stack in {stack_dir}.")
+            return meta
+        except ValueError as e:
+            logger.info(f"{e} Building it again.")
+
+    # The crop has to leave room for the whole ROI around every coordinate
+    margin = margin if margin < 0 else max(margin, roi_size)
+    return build_stack(
+        folder_path, stack_dir, coordinates, decode, margin, color, workers, metrics
+    )
+
+
+def process_stack(
+    stack_dir,
+    coordinates,
+    time_interval=5,
+    roi_size=5,
+    metrics=None,
+    skip=None,
+    timeline=None,
+):
+    """
+    Same results as process_images on the pictures of the stack, but the ROIs
+    are read from the memory mapped frames instead of decoding every picture.
+    Frames of pictures in skip are left out, a timeline gives the time of every
+    picture as in process_images.
+    """
+    frames, meta = open_stack(stack_dir)
+    plan = stack_plan(build_roi_plan(coordinates, roi_size, meta["decode"]), meta)
+    results = []
+
+    late = _untimed([filename for _, filename in meta["frames"]], timeline)
+    time = -time_interval
+    with stage(metrics, "roi_extraction"):
+        for (_, filename), frame in zip(meta["frames"], frames):
+            if filename in (skip or ()) or filename in late:
+                continue
+
+            means = roi_means(frame, plan)
+            if timeline is not None:
+                time = timeline[filename]
+            else:
+                time += time_interval
+            results.extend(frame_rows(time, means, plan))
+            count(metrics, "frames_stacked")
+    return results
@@ -1,19 +1,76 @@
 import numpy as np
+from scipy.special import ndtr, ndtri
+
+
+# Means of n_iterations resamples of values, drawn as index matrices of at most
+# max_elements entries at a time to bound the memory use
+def _resample_means(values, n_iterations, rng, max_elements=10_000_000):
+    n = len(values)
+    rows = max(1, max_elements // n)
+
+    bootstrap_means = np.empty(n_iterations)
+    for start in range(0, n_iterations, rows):
+        stop = min(start + rows, n_iterations)
+        indices = rng.integers(0, n, size=(stop - start, n))
+        bootstrap_means[start:stop] = values[indices].mean(axis=1)
+    return bootstrap_means
+
+
+# Bias corrected and accelerated interval, falls back to the percentile interval
+# when the correction is undefined (e.g. all values the same)
+def _bca_interval(values, bootstrap_means, alpha):
+    mean = np.mean(values)
+    z0 = ndtri(np.mean(bootstrap_means < mean))
+    percentiles = [100 * (alpha / 2), 100 * (1 - alpha / 2)]
+    if not np.isfinite(z0):
+        return tuple(np.percentile(bootstrap_means, percentiles))
+
+    # Acceleration from the jackknife means
+    jackknife = (values.sum() - values) / (len(values) - 1)
+    diff = jackknife.mean() - jackknife
+    denominator = 6 * np.sum(diff**2) ** 1.5
+    a = np.sum(diff**3) / denominator if denominator > 0 else 0.0
+
+    z = ndtri([alpha / 2, 1 - alpha / 2])
+    adjusted = 100 * ndtr(z0 + (z0 + z) / (1 - a * (z0 + z)))
+    if np.all(np.isfinite(adjusted)):
+        percentiles = adjusted
+
+    lower, upper = np.percentile(bootstrap_means, percentiles)
+    return lower, upper
 
 
 # Determine a 95% bootstrap confidence interval for the halftime values
 # with the assumption that they are the same
-def bootstrap_mean(halftimes, n_iterations=10000, alpha=0.05):
-    # Collect the mean of each bootstrap sample
-    bootstrap_means = []
-    for _ in range(n_iterations):
-        sample = np.random.choice(halftimes, size=len(halftimes), replace=True)
-        bootstrap_means.append(np.mean(sample))
-    bootstrap_means = np.array(bootstrap_means)
-
-    # Calculate the lower and upper percentiles
-    lower = np.percentile(bootstrap_means, 100 * (alpha / 2))
-    upper = np.percentile(bootstrap_means, 100 * (1 - alpha / 2))
+def bootstrap_mean(
+    halftimes, n_iterations=10000, alpha=0.05, seed=None, method="percentile"
+):
+    halftimes = np.asarray(halftimes, dtype=np.float64)
+    if len(halftimes) == 0:
+        return ((np.nan, np.nan), np.nan)
+
+    # All resamples at once, seed makes the interval reproducible
+    rng = np.random.default_rng(seed)
+    bootstrap_means = _resample_means(halftimes, n_iterations, rng)
+
+    if method == "bca" and len(halftimes) > 1:
+        lower, upper = _bca_interval(halftimes, bootstrap_means, alpha)
+    else:
+        # Calculate the lower and upper percentiles
+        lower = np.percentile(bootstrap_means, 100 * (alpha / 2))
+        upper = np.percentile(bootstrap_means, 100 * (1 - alpha / 2))
 
     # Return a tuple: (confidence interval tuple, mean of the original halftimes)
     return ((lower, upper), np.mean(halftimes))
+
+
+# Bootstrap every sample in one call, each sample gets its own random stream
+# spawned from seed so its interval doesn't depend on the other samples
+def bootstrap_means(
+    samples, n_iterations=10000, alpha=0.05, seed=None, method="percentile"
+):
+    seeds = np.random.SeedSequence(seed).spawn(len(samples))
+    return [
+        bootstrap_mean(halftimes, n_iterations, alpha, sample_seed, method)
+        for halftimes, sample_seed in zip(samples, seeds)
+    ]
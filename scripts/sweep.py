@@ -0,0 +1,211 @@
+import os
+import cv2
+import numpy as np
+import pandas as pd
+from concurrent import futures
+from itertools import product
+import logging
+from scripts.image_analysis import (
+    pictures,
+    read_frame,
+    build_roi_plan,
+    frame_rows,
+    _plan_bounds,
+    _untimed,
+)
+from scripts.results import results_to_store
+from scripts.plots import store_halftimes
+from scripts.stat_test import bootstrap_means
+from scripts.metrics import stage, add_time, count, record, clock, elapsed
+
+logger = logging.getLogger(__name__)
+
+# A sweep evaluates several roi sizes and halftime settings in one run. Every
+# frame is decoded and converted once and the ROI sums of all roi sizes are
+# read from the same integral image, then the halftimes and bootstrap intervals
+# of every combination are collected in one table.
+
+
+def sweep_means(image, plans):
+    """
+    roi_means for several plans of the same coordinates (different roi sizes)
+    from a single integral image. Returns a list of means, one per plan.
+    """
+    bounds = [_plan_bounds(plan, image.shape[:2]) for plan in plans]
+    valid = bounds[0][5]
+    if not valid.any():
+        return [np.full(len(valid), -1.0) for _ in plans]
+
+    # The largest ROIs decide the part of the frame that is converted
+    top = min(b[6][0] for b in bounds)
+    bottom = max(b[6][1] for b in bounds)
+    left = min(b[6][2] for b in bounds)
+    right = max(b[6][3] for b in bounds)
+
+    crop = image[top:bottom, left:right]
+    gray = crop if crop.ndim == 2 else cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+    integral = cv2.integral(gray, sdepth=cv2.CV_64F)
+
+    all_means = []
+    for x1, x2, y1, y2, area, _, box in bounds:
+        # Bounds are relative to the box of the plan, move them into the crop
+        x1, x2 = x1 + box[2] - left, x2 + box[2] - left
+        y1, y2 = y1 + box[0] - top, y2 + box[0] - top
+        sums = integral[y2, x2] - integral[y1, x2] - integral[y2, x1] + integral[y1, x1]
+
+        means = np.full(len(valid), -1.0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            means[valid] = sums[valid] / area[valid]
+        all_means.append(means)
+    return all_means
+
+
+def process_images_sweep(
+    folder_path,
+    coordinates,
+    time_interval=5,
+    roi_sizes=(5,),
+    decode="full",
+    workers=None,
+    metrics=None,
+    timeline=None,
+):
+    """
+    Same results as process_images for every roi size in roi_sizes, from a single
+    decode of each picture. Returns a dict of results per roi size.
+    """
+    logger.info(
+        f"Processing images for a sweep of roi_sizes={list(roi_sizes)} with decode={decode}."
+    )
+    plans = [build_roi_plan(coordinates, r, decode) for r in roi_sizes]
+    if plans[0]["shapes"]:
+        raise ValueError("A roi size sweep only supports square ROIs.")
+    results = {r: [] for r in roi_sizes}
+
+    with stage(metrics, "listing"):
+        filenames = [filename for _, filename in pictures(folder_path)]
+        late = _untimed(filenames, timeline)
+        filenames = [filename for filename in filenames if filename not in late]
+
+    def analyse(filename):
+        start = clock()
+        image = read_frame(os.path.join(folder_path, filename), decode)
+        decode_s, start = elapsed(start), clock()
+        all_means = None if image is None else sweep_means(image, plans)
+        return all_means, decode_s, elapsed(start)
+
+    # Decoding releases the GIL, so threads overlap the pictures
+    time = -time_interval
+    with futures.ThreadPoolExecutor(max_workers=workers) as ex:
+        for filename, (all_means, decode_s, roi_s) in zip(
+            filenames, ex.map(analyse, filenames)
+        ):
+            add_time(metrics, "decode", *decode_s)
+            add_time(metrics, "roi_extraction", *roi_s)
+            record(metrics, "decode_latency", decode_s[0])
+            if all_means is None:
+                logger.warning(f"Could not read {filename}, skipping.")
+                count(metrics, "frames_unreadable")
+                continue
+
+            count(metrics, "frames_decoded")
+            if timeline is not None:
+                time = timeline[filename]
+            else:
+                time += time_interval
+            for r, plan, means in zip(roi_sizes, plans, all_means):
+                results[r].extend(frame_rows(time, means, plan))
+    return results
+
+
+def run_sweep(
+    folder_path,
+    coordinates,
+    output_path,
+    time_interval=5,
+    roi_sizes=(5,),
+    windows=(11,),
+    jumps=(5,),
+    decode="full",
+    workers=None,
+    backend="ruptures",
+    seed=0,
+    ci_method="percentile",
+    metrics=None,
+    timeline=None,
+):
+    """
+    Halftimes and bootstrap intervals of every sample for every combination of
+    roi size, savgol window length and breakpoint jump, written to
+    output_path/sweep_results.csv. Returns the table as a DataFrame.
+    """
+    for window in windows:
+        if window < 3 or window % 2 == 0:
+            raise ValueError(
+                f"The savgol window must be odd and at least 3, not {window}."
+            )
+
+    with stage(metrics, "analysis"):
+        all_results = process_images_sweep(
+            folder_path,
+            coordinates,
+            time_interval,
+            roi_sizes,
+            decode,
+            workers,
+            metrics,
+            timeline,
+        )
+
+    table = []
+    for roi_size in roi_sizes:
+        store = results_to_store(all_results[roi_size])
+        for window, jump in product(windows, jumps):
+            logger.info(
+                f"Sweep roi_size={roi_size}, window_length={window} and jump={jump}."
+            )
+            with stage(metrics, "halftime"):
+                halftimes = store_halftimes(
+                    store,
+                    window_length=window,
+                    workers=workers,
+                    backend=backend,
+                    jump=jump,
+                )
+
+            data = [h[~np.isnan(h)] for h in halftimes.values()]
+            with stage(metrics, "bootstrap"):
+                intervals = bootstrap_means(data, seed=seed, method=ci_method)
+
+            for name, h, ((lower, upper), mean) in zip(halftimes, data, intervals):
+                table.append(
+                    (
+                        roi_size,
+                        window,
+                        jump,
+                        name,
+                        len(h),
+                        len(halftimes[name]) - len(h),
+                        mean,
+                        lower,
+                        upper,
+                    )
+                )
+
+    table = pd.DataFrame(
+        table,
+        columns=[
+            "roi_size",
+            "window_length",
+            "jump",
+            "name",
+            "n",
+            "failed",
+            "mean",
+            "lower",
+            "upper",
+        ],
+    )
+    table["ci_width"] = table["upper"] - table["lower"]
+    table.to_csv(os.path.join(output_path, "sweep_results.csv"), index=False)
+    return table
@@ -0,0 +1,152 @@
+import os
+import json
+import numpy as np
+from datetime import datetime
+from PIL import Image
+import logging
+from scripts.image_analysis import pictures
+
+logger = logging.getLogger(__name__)
+
+# The timeline maps every picture to its time in minutes since the first
+# picture. The capture time is read from the EXIF header (Pillow only parses the
+# header, the pixels are not decoded) or from the filename with a strptime
+# pattern, and falls back to the fixed -t interval times the position in the
+# sorted directory. Pictures without a timestamp are placed by interpolating
+# their neighbours, so a dropped or unreadable picture leaves a gap in time
+# instead of shifting every later picture.
+
+EXIF_IFD = 0x8769
+DATETIME_ORIGINAL = 36867
+SUBSEC_ORIGINAL = 37521
+DATETIME = 306
+EPOCH = datetime(1970, 1, 1)
+
+
+def _seconds(stamp):
+    # Camera and filename times have no time zone. They are counted from a naive
+    # epoch, not converted from the local time zone of this machine, so a run
+    # across a daylight saving change doesn't gain or lose an hour
+    if stamp.tzinfo is not None:
+        return stamp.timestamp()
+    return (stamp - EPOCH).total_seconds()
+
+
+def exif_time(image_path):
+    """
+    Capture time of a picture in seconds since 1970-01-01 in the time of the
+    camera, None if it has none.
+    """
+    try:
+        with Image.open(image_path) as image:
+            exif = image.getexif()
+        details = exif.get_ifd(EXIF_IFD)
+        value = details.get(DATETIME_ORIGINAL) or exif.get(DATETIME)
+        if not value:
+            return None
+
+        stamp = datetime.strptime(value.strip("\x00 "), "%Y:%m:%d %H:%M:%S")
+        seconds = _seconds(stamp)
+        subsec = str(details.get(SUBSEC_ORIGINAL, "")).strip("\x00 ")
+        if subsec.isdigit():
+            seconds += int(subsec) / 10 ** len(subsec)
+        return seconds
+    except Exception:
+        return None
+
+
+def filename_time(filename, pattern):
+    """
+    Time in seconds since 1970-01-01 parsed from the filename (without extension)
+    with a strptime pattern, e.g. "IMG_%Y%m%d_%H%M%S". None if it doesn't match.
+    """
+    try:
+        stem = os.path.splitext(filename)[0]
+        return _seconds(datetime.strptime(stem, pattern))
+    except ValueError:
+        return None
+
+
+def _cached_exif_times(folder_path, filenames, cache_dir):
+    # The EXIF times of unchanged pictures are kept in timeline.json. The key ends
+    # in "naive" since times were in the local time zone before
+    cache = {}
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, "timeline.json")
+        try:
+            with open(cache_path) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+
+    stamps = []
+    for filename in filenames:
+        path = os.path.abspath(os.path.join(folder_path, filename))
+        stat = os.stat(path)
+        key = f"{path}|{stat.st_mtime_ns}|{stat.st_size}|naive"
+        if key not in cache:
+            cache[key] = exif_time(path)
+        stamps.append(cache[key])
+
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_path, "w") as f:
+            json.dump(cache, f)
+    return stamps
+
+
+def _fill_missing(stamps):
+    # Interpolate the pictures without a time between their neighbours
+    stamps = np.array([np.nan if s is None else s for s in stamps], dtype=np.float64)
+    known = ~np.isnan(stamps)
+    index = np.arange(len(stamps))
+    if known.sum() < len(stamps):
+        logger.warning(
+            f"{len(stamps) - known.sum()} pictures have no timestamp, interpolating."
+        )
+        stamps = np.interp(index, index[known], stamps[known])
+    return stamps
+
+
+def build_timeline(
+    folder_path, time_interval=5, source="auto", pattern=None, cache_dir=None
+):
+    """
+    Time in minutes of every picture in folder_path as a dict of filename to time,
+    and the source that was used. source is exif, filename (needs pattern),
+    interval (time_interval minutes between the pictures) or auto, which uses the
+    first of these that gives at least two timestamps.
+    """
+    filenames = [filename for _, filename in pictures(folder_path)]
+    if source == "filename" and not pattern:
+        raise ValueError("A filename pattern is needed for timestamps from filenames.")
+
+    candidates = {"auto": ["exif", "filename"], "interval": []}.get(source, [source])
+    used = "interval"
+    for candidate in candidates:
+        if candidate == "exif":
+            stamps = _cached_exif_times(folder_path, filenames, cache_dir)
+        elif pattern:
+            stamps = [filename_time(filename, pattern) for filename in filenames]
+        else:
+            continue
+
+        if sum(s is not None for s in stamps) >= 2:
+            used = candidate
+            break
+        if source != "auto":
+            raise ValueError(
+                f"Less than two pictures have a timestamp in the {source}."
+            )
+
+    if used == "interval":
+        times = np.arange(len(filenames)) * float(time_interval)
+    else:
+        stamps = _fill_missing(stamps)
+        if np.any(np.diff(stamps) < 0):
+            logger.warning("The timestamps are not in the order of the filenames.")
+        times = (stamps - stamps[0]) / 60
+
+    logger.info(f"Timeline of {len(filenames)} pictures from {used}.")
+    return dict(zip(filenames, times.tolist())), used
@@ -0,0 +1,151 @@
+import os
+import time
+import numpy as np
+import logging
+from scripts.image_analysis import (
+    pictures,
+    build_roi_plan,
+    read_frame,
+    roi_means,
+    frame_rows,
+)
+from scripts.cache import analysis_key, frame_key, cache_get, cache_put
+from scripts.results import open_writer, write_frame, close_writer
+from scripts.plots import batch_halftimes
+from scripts.stat_test import bootstrap_mean
+
+logger = logging.getLogger(__name__)
+
+
+def _ready_files(folder_path, seen, settle_time):
+    """
+    Files that have not changed since the last poll and are older than settle_time,
+    so the camera is done writing them.
+    """
+    now = time.time()
+    ready = []
+    for _, filename in pictures(folder_path):
+        if seen.get(filename) == "done":
+            continue
+
+        stat = os.stat(os.path.join(folder_path, filename))
+        state = (stat.st_size, stat.st_mtime_ns)
+        if seen.get(filename) == state and now - stat.st_mtime >= settle_time:
+            ready.append(filename)
+        else:
+            seen[filename] = state
+    return ready
+
+
+def live_halftimes(curves, path, backend="ruptures", seed=0, ci_method="percentile"):
+    """
+    Write the current halftime estimates for every sample, in the same format as
+    bootstrap_results.txt. seed and ci_method are those of the bootstrap of the
+    run, so the live intervals are reproducible.
+    """
+    with open(path, "w") as f:
+        f.write("name, mean, conf_in\n")
+        for name, (x, grays) in curves.items():
+            # The smoothing window needs at least 11 frames
+            if len(x) < 11:
+                continue
+
+            h_times = batch_halftimes(x, np.array(grays).T, backend=backend)
+            halftimes = h_times[~np.isnan(h_times)].tolist()
+
+            if halftimes:
+                conf_values, mean_value = bootstrap_mean(
+                    halftimes, seed=seed, method=ci_method
+                )
+                conf_str = f"[{conf_values[0]}, {conf_values[1]}]"
+                f.write(f"{name}, {mean_value}, {conf_str}\n")
+
+
+def watch_images(
+    folder_path,
+    coordinates,
+    output_path,
+    time_interval=5,
+    roi_size=5,
+    decode="full",
+    poll_interval=10,
+    settle_time=5,
+    refresh_every=12,
+    idle_timeout=None,
+    cache=None,
+    backend="ruptures",
+    seed=0,
+    ci_method="percentile",
+):
+    """
+    Analyse the pictures as the camera writes them. Rows are appended to
+    results.csv as every frame lands and the halftime estimates in
+    halftimes_live.txt are refreshed every refresh_every frames.
+    Stops after idle_timeout seconds without new frames, or on Ctrl-C, and
+    returns the results store.
+    """
+    logger.info(
+        f"Watching {folder_path} with poll_interval={poll_interval}, settle_time={settle_time} and idle_timeout={idle_timeout}."
+    )
+    try:
+        plan = build_roi_plan(coordinates, roi_size, decode)
+        if cache is not None:
+            analysis = analysis_key(coordinates, roi_size, decode)
+
+        live_file = os.path.join(output_path, "halftimes_live.txt")
+        curves = {name: ([], []) for name in plan["samples"]}
+        seen = {}
+        time_point = -time_interval
+        n_frames = 0
+        last_frame = time.time()
+
+        # Frames come in time order, so every frame is written and flushed at once
+        writer = open_writer(output_path, buffer=0, flush_every=1)
+        try:
+            while True:
+                for filename in _ready_files(folder_path, seen, settle_time):
+                    seen[filename] = "done"
+                    image_path = os.path.join(folder_path, filename)
+
+                    means = None
+                    if cache is not None:
+                        key = frame_key(image_path, analysis)
+                        means = cache_get(cache, key)
+
+                    if means is None:
+                        image = read_frame(image_path, decode)
+                        if image is None:
+                            logger.warning(f"Could not read {image_path}, skipping.")
+                            continue
+
+                        means = roi_means(image, plan)
+                        if cache is not None:
+                            cache_put(cache, key, means)
+
+                    time_point += time_interval
+                    rows = frame_rows(time_point, means, plan)
+                    write_frame(writer, rows)
+                    for row in rows:
+                        curves[row[1]][0].append(row[0])
+                        curves[row[1]][1].append(row[4])
+
+                    n_frames += 1
+                    last_frame = time.time()
+                    if n_frames % refresh_every == 0:
+                        live_halftimes(curves, live_file, backend, seed, ci_method)
+                        logger.info(f"{n_frames} frames analysed.")
+
+                if idle_timeout is not None and time.time() - last_frame > idle_timeout:
+                    logger.info("No new frames, stopping watch mode.")
+                    break
+
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            logger.info("Watch mode interrupted.")
+        finally:
+            store = close_writer(writer)
+
+        live_halftimes(curves, live_file, backend, seed, ci_method)
+        return store
+    except Exception as e:
+        logger.error(f"Error: {e}", exc_info=True)